@@ -0,0 +1,71 @@
+"""Compares the optimizer with native (matrix) and Python callback transit evaluators.
+
+Both runs get the same model and the same 1 second time limit, the difference is how much
+search fits in it. --default-stall keeps the size based stall stop, which then ends the runs
+that stop improving early. Run from Services/Optimizer_AzureMaps:
+
+    python -m examples.benchmark_transit --waypoints 50 100 200
+    python -m examples.benchmark_transit --waypoints 50 100 200 --default-stall
+"""
+import argparse
+import asyncio
+import random
+
+from mio.service.matrix_provider import DeterministicProvider
+from mio.service.optimizer import solve
+
+
+def random_data(num_waypoints, num_vehicles, shifts, seed, default_stall=False):
+    random.seed(seed)
+    # Around Seattle, vehicles start and end at their own depots
+    num_points = 2 * num_vehicles + num_waypoints
+    points = [[-122.33 + random.uniform(-0.2, 0.2), 47.6 + random.uniform(-0.15, 0.15)] for _ in range(num_points)]
+    matrix = asyncio.run(DeterministicProvider(max_cells=10**9).matrix(points, points))
+    data = {
+        "time_matrix": matrix.durations.tolist(),
+        "distance_matrix": matrix.distances.round().astype(int).tolist(),
+        "num_vehicles": num_vehicles,
+        "starts": list(range(num_vehicles)),
+        "ends": list(range(num_vehicles, 2 * num_vehicles)),
+        # A fixed 1 second search for both runs, without the size based time limit and the stall stop
+        "search": {"time_limit": 1, "stall_seconds": 0}
+    }
+    if default_stall:
+        del data["search"]["stall_seconds"]
+    if shifts:
+        data["vehicle_shifts"] = [[0, 8 * 60]] * num_vehicles
+    return data
+
+
+def run(data, native_transits):
+    manager, routing, solution = solve(data, native_transits=native_transits)
+    solver = routing.solver()
+    return {
+        "objective": solution.ObjectiveValue() if solution else None,
+        "solutions": solver.Solutions(),
+        "branches": solver.Branches(),
+        "neighbors": solver.AcceptedNeighbors(),
+        "seconds": solver.WallTime() / 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--waypoints", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--vehicles", type=int, default=5)
+    parser.add_argument("--shifts", action="store_true", help="add vehicle shifts, which adds the Time dimension")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--default-stall", action="store_true", help="keep the size based stall stop")
+    args = parser.parse_args()
+
+    print(f"{'waypoints':>9} {'transits':>8} {'objective':>10} {'solutions':>9} {'branches':>9} {'neighbors':>9} {'seconds':>7}")
+    for num_waypoints in args.waypoints:
+        data = random_data(num_waypoints, args.vehicles, args.shifts, args.seed, args.default_stall)
+        for native_transits in (False, True):
+            stats = run(data, native_transits)
+            print(f"{num_waypoints:>9} {'matrix' if native_transits else 'callback':>8} {stats['objective']:>10} "
+                  f"{stats['solutions']:>9} {stats['branches']:>9} {stats['neighbors']:>9} {stats['seconds']:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
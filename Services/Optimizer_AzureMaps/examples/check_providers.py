@@ -0,0 +1,130 @@
+"""Runs the route matrix providers against examples/stub_server.py and checks the requests they make.
+
+Every check starts its own stub, fetches a matrix and compares it with the stub travel times.
+Run from Services/Optimizer_AzureMaps:
+
+    python -m examples.check_providers
+"""
+import asyncio
+import random
+
+import numpy as np
+
+from mio.service.azure_maps_api import AzureMapsApi, AzureMapsProvider
+from mio.service.bing_maps_api import BingMapsApi, BingMapsProvider
+from mio.service.hedged_provider import HedgedProvider
+from mio.utils.http_session import close_session
+from examples.stub_server import StubServer, start, stub_matrix
+
+PORT = 8765
+# Second stub for the checks with two providers
+SECONDARY_PORT = 8766
+
+
+def random_points(count, seed=0):
+    random.seed(seed)
+    # Around Seattle, as [lon, lat]
+    return [[-122.33 + random.uniform(-0.2, 0.2), 47.6 + random.uniform(-0.15, 0.15)] for _ in range(count)]
+
+
+def check_matrix(name, result, points):
+    durations, distances = stub_matrix(points, points)
+    assert result.all_valid(), f"{name}: {int((~result.valid).sum())} cells not routed"
+    assert np.array_equal(result.durations, durations), f"{name}: durations differ from the stub"
+    assert np.allclose(result.distances, distances), f"{name}: distances differ from the stub"
+
+
+async def check_azure_sync():
+    server = StubServer()
+    runner = await start(server, PORT)
+    try:
+        points = random_points(12)
+        provider = AzureMapsProvider(AzureMapsApi("stub", base_url=f"http://localhost:{PORT}"))
+        check_matrix("azure sync", await provider.matrix(points, points), points)
+        # 144 cells are 2 tiles within the 100 cells of a sync request
+        assert server.requests == {"azure_sync": 2}, server.requests
+    finally:
+        await runner.cleanup()
+    return "2 sync tiles"
+
+
+async def check_azure_async():
+    server = StubServer(polls=2, retry_after=1)
+    runner = await start(server, PORT)
+    try:
+        points = random_points(20)
+        provider = AzureMapsProvider(AzureMapsApi("stub", base_url=f"http://localhost:{PORT}"), async_threshold=0)
+        check_matrix("azure async", await provider.matrix(points, points), points)
+        # Every 400 cell tile is submitted (202 with Location), polled twice with 202, then once with 200
+        assert server.requests == {"azure_submit": 1, "azure_status": 3}, server.requests
+    finally:
+        await runner.cleanup()
+    return "submit 202, 2 polls 202, poll 200"
+
+
+async def check_bing_async():
+    server = StubServer(polls=2, retry_after=1)
+    runner = await start(server, PORT)
+    try:
+        points = random_points(20)
+        # Only chunks larger than a sync request become jobs
+        provider = BingMapsProvider(BingMapsApi("stub", base_url=f"http://localhost:{PORT}"), max_cells=100, async_threshold=0)
+        check_matrix("bing async", await provider.matrix(points, points), points)
+        # Polled on DistanceMatrixAsyncCallback, the resultUrl download fails when the key is added to it
+        assert server.requests == {"bing_submit": 1, "bing_status": 3, "bing_download": 1}, server.requests
+    finally:
+        await runner.cleanup()
+    return "submit, 2 polls not completed, poll completed, download"
+
+
+async def check_hedged(primary_server, hedge_after):
+    """Fetches a matrix with Azure Maps on primary_server hedged with a healthy Bing Maps stub."""
+    secondary_server = StubServer()
+    runners = [await start(primary_server, PORT), await start(secondary_server, SECONDARY_PORT)]
+    try:
+        points = random_points(30)
+        provider = HedgedProvider(
+            AzureMapsProvider(AzureMapsApi("stub", base_url=f"http://localhost:{PORT}")),
+            BingMapsProvider(BingMapsApi("stub", base_url=f"http://localhost:{SECONDARY_PORT}")),
+            hedge_after=hedge_after
+        )
+        check_matrix("hedged", await provider.matrix(points, points), points)
+        return provider.stats, secondary_server.requests
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+async def check_hedge():
+    # Azure Maps answers after 1 second, Bing Maps is asked after 0.2 second and wins every tile
+    stats, secondary_requests = await check_hedged(StubServer(latency=1.0), hedge_after=0.2)
+    assert stats["hedged"] == stats["tiles"] == stats["bing"] == secondary_requests["bing_sync"], stats
+    assert stats["azure"] == stats["failovers"] == 0, stats
+    return f"{stats['hedged']} of {stats['tiles']} tiles hedged to bing"
+
+
+async def check_failover():
+    # Azure Maps throttles every request, each tile fails over to Bing Maps without waiting for hedge_after
+    primary_server = StubServer(error_rate=1.0, error_status=429)
+    stats, secondary_requests = await check_hedged(primary_server, hedge_after=10)
+    assert stats["failovers"] == stats["tiles"] == stats["bing"] == primary_server.requests["azure_sync"], stats
+    assert stats["azure"] == stats["hedged"] == 0, stats
+    return f"{stats['failovers']} of {stats['tiles']} tiles failed over to bing after a 429"
+
+
+CHECKS = [check_azure_sync, check_azure_async, check_bing_async, check_hedge, check_failover]
+
+
+async def run_checks():
+    try:
+        for check in CHECKS:
+            loop = asyncio.get_running_loop()
+            start_time = loop.time()
+            detail = await check()
+            print(f"{check.__name__}: ok in {loop.time() - start_time:.2f}s ({detail})")
+    finally:
+        await close_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_checks())
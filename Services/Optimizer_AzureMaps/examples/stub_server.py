@@ -0,0 +1,191 @@
+"""Local stand-in for the Azure Maps and Bing Maps route matrix endpoints, to run the providers without keys.
+
+Travel times are the great-circle distance driven at 40 km/h. Async jobs answer 202 to the
+submit and to the first --polls status requests, then 200. --latency delays every matrix
+request and --error-rate answers that share of them with --error-status (429 by default).
+Run from the app folder and point the app at it:
+
+    python -m examples.stub_server --port 8765 --latency 0.2
+    MIO_AZURE_MAPS_URL=http://localhost:8765 MIO_BING_MAPS_URL=http://localhost:8765 API_KEY=stub BME_KEY=stub func start
+"""
+import argparse
+import asyncio
+import itertools
+import random
+
+from aiohttp import web
+
+from mio.utils.geo import great_circle_matrix
+
+SPEED_KPH = 40
+
+
+def stub_matrix(origins, destinations):
+    """(durations in seconds, distances in meters) between [lon, lat] points."""
+    distances = great_circle_matrix(origins, destinations)
+    return (distances * (3.6 / SPEED_KPH)).round().astype(int).tolist(), distances.round().astype(int).tolist()
+
+
+def azure_result(body):
+    durations, distances = stub_matrix(body["origins"]["coordinates"], body["destinations"]["coordinates"])
+    matrix = [[{"statusCode": 200, "response": {"routeSummary": {"travelTimeInSeconds": d, "lengthInMeters": m}}}
+               for d, m in zip(row_durations, row_distances)]
+              for row_durations, row_distances in zip(durations, distances)]
+    return {"formatVersion": "0.0.1", "matrix": matrix,
+            "summary": {"successfulRoutes": sum(map(len, matrix)), "totalRoutes": sum(map(len, matrix))}}
+
+
+def bing_result(body):
+    origins = [[p["longitude"], p["latitude"]] for p in body["origins"]]
+    destinations = [[p["longitude"], p["latitude"]] for p in body["destinations"]]
+    durations, distances = stub_matrix(origins, destinations)
+    return [{"originIndex": i, "destinationIndex": j, "travelDuration": durations[i][j], "travelDistance": distances[i][j] / 1000}
+            for i in range(len(origins)) for j in range(len(destinations))]
+
+
+def bing_resource(resource, status=200):
+    return {"statusCode": status, "resourceSets": [{"estimatedTotal": 1, "resources": [resource]}]}
+
+
+class StubServer:
+    """Route matrix endpoints with configurable latency, errors and async job length.
+
+    requests counts the requests per endpoint so a check can tell which flow was taken.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=429, polls=2, retry_after=1, seed=0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.polls = polls
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.job_ids = itertools.count(1)
+        # job id -> [status requests left before it completes, result]
+        self.jobs = {}
+        self.requests = {}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/route/matrix/sync/json", self.azure_sync)
+        app.router.add_post("/route/matrix/json", self.azure_submit)
+        app.router.add_get("/route/matrix/{job_id}", self.azure_status)
+        app.router.add_post("/REST/v1/Routes/DistanceMatrix", self.bing_sync)
+        app.router.add_post("/REST/v1/Routes/DistanceMatrixAsync", self.bing_submit)
+        app.router.add_get("/REST/v1/Routes/DistanceMatrixAsyncCallback", self.bing_status)
+        app.router.add_get("/results/{job_id}", self.bing_download)
+        return app
+
+    async def call(self, request, name, key):
+        """Counts the request, applies the latency and errors, returns an error response or None.
+
+        An empty aiohttp response is falsy (it is a mapping), callers compare with None."""
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if not request.query.get(key):
+            return web.json_response({"error": {"code": "401 Unauthorized"}}, status=401)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            return web.json_response({"error": {"code": f"{self.error_status}"}}, status=self.error_status)
+        return None
+
+    def submit(self, result):
+        job_id = str(next(self.job_ids))
+        self.jobs[job_id] = [self.polls, result]
+        return job_id
+
+    def poll(self, job_id):
+        """The result once the job has been polled often enough, else None."""
+        job = self.jobs[job_id]
+        if job[0] > 0:
+            job[0] -= 1
+            return None
+        return job[1]
+
+    async def azure_sync(self, request):
+        body = await request.json()
+        if len(body["origins"]["coordinates"]) * len(body["destinations"]["coordinates"]) > 100:
+            return web.json_response({"error": {"code": "400 BadRequest"}}, status=400)
+        error = await self.call(request, "azure_sync", "subscription-key")
+        if error is not None:
+            return error
+        return web.json_response(azure_result(body))
+
+    async def azure_submit(self, request):
+        body = await request.json()
+        if len(body["origins"]["coordinates"]) * len(body["destinations"]["coordinates"]) > 700:
+            return web.json_response({"error": {"code": "400 BadRequest"}}, status=400)
+        error = await self.call(request, "azure_submit", "subscription-key")
+        if error is not None:
+            return error
+        # Like the service, the Location url does not carry the subscription key
+        location = f"{request.scheme}://{request.host}/route/matrix/{self.submit(azure_result(body))}?api-version=1.0"
+        return web.Response(status=202, headers={"Location": location, "Retry-After": str(self.retry_after)})
+
+    async def azure_status(self, request):
+        error = await self.call(request, "azure_status", "subscription-key")
+        if error is not None:
+            return error
+        result = self.poll(request.match_info["job_id"])
+        if result is None:
+            return web.Response(status=202, headers={"Retry-After": str(self.retry_after)})
+        return web.json_response(result)
+
+    async def bing_sync(self, request):
+        body = await request.json()
+        error = await self.call(request, "bing_sync", "key")
+        if error is not None:
+            return error
+        return web.json_response(bing_resource({"results": bing_result(body)}))
+
+    async def bing_submit(self, request):
+        body = await request.json()
+        error = await self.call(request, "bing_submit", "key")
+        if error is not None:
+            return error
+        job_id = self.submit({"results": bing_result(body)})
+        return web.json_response(bing_resource(
+            {"requestId": job_id, "isCompleted": False, "callbackInterval": self.retry_after}, status=202))
+
+    async def bing_status(self, request):
+        error = await self.call(request, "bing_status", "key")
+        if error is not None:
+            return error
+        job_id = request.query["requestId"]
+        if self.poll(job_id) is None:
+            return web.json_response(bing_resource(
+                {"requestId": job_id, "isCompleted": False, "callbackInterval": self.retry_after}))
+        return web.json_response(bing_resource({
+            "requestId": job_id, "isCompleted": True,
+            "resultUrl": f"{request.scheme}://{request.host}/results/{job_id}?sv=stub&sig=stub"}))
+
+    async def bing_download(self, request):
+        self.requests["bing_download"] = self.requests.get("bing_download", 0) + 1
+        # resultUrl is a signed blob url, the storage service rejects unknown query parameters
+        if "key" in request.query or request.query.get("sig") != "stub":
+            return web.Response(status=403, text="AuthenticationFailed")
+        return web.json_response(self.jobs[request.match_info["job_id"]][1])
+
+
+async def start(server, port):
+    """Serves server on localhost:port, returns the runner to clean up."""
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every matrix request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of the matrix requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--polls", type=int, default=2, help="status requests answered 202 before an async job completes")
+    parser.add_argument("--retry-after", type=int, default=1, help="seconds the async status responses ask to wait")
+    args = parser.parse_args()
+    server = StubServer(args.latency, args.error_rate, args.error_status, args.polls, args.retry_after)
+    web.run_app(server.app(), host="localhost", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
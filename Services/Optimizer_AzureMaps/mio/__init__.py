@@ -1,20 +1,181 @@
 import os
+import math
+import time
+import asyncio
+import threading
 import logging
 import json
 import http.client
 from pathlib import Path
+from datetime import datetime, timedelta
 from urllib.parse import unquote
 
 import azure.functions as func
 import aiofiles
+import numpy as np
 
-from mio.service.azure_maps_api import AzureMapsApi
-from mio.service.optimizer import optimizer
+from mio.service.azure_maps_api import AzureMapsApi, AzureMapsProvider
+from mio.service.bing_maps_api import BingMapsApi, BingMapsProvider
+from mio.service.hedged_provider import HedgedProvider
+from mio.service.matrix_cache import RouteMatrixCache
+from mio.service.matrix_provider import MatrixResult, EstimateProvider
+from mio.service.sparse_matrix import sparse_route_matrix
+from mio.service.optimizer import optimizer, limit_pool_workers
+from mio.utils.geo import unique_points
 from mio.utils.log import init_log
+from mio.utils.solution_cache import SolutionCache
+from mio.utils.solver_executor import SolverExecutor, SolverBusyError
+from mio.utils.single_flight import SingleFlight
 
-test_data = Path("examples/data/2_vehicles_3_waypoints.json").read_text()
+# The solver processes import this package too, so nothing is read or opened here before a request needs it
+test_data_path = Path("examples/data/2_vehicles_3_waypoints.json")
 
-async def mio(data: str) -> (int, str):
+# The cache lives as long as the Function host process, so it is shared across invocations
+# It is opened by the first request, see get_matrix_cache()
+matrix_cache = None
+# Concurrent requests for the same matrix share one call to the provider
+matrix_flights = SingleFlight()
+# Points equal up to MIO_COORD_PRECISION decimals (6 is about 10 cm) are requested only once
+coord_precision = int(os.getenv("MIO_COORD_PRECISION", "6"))
+# Defaults of the great-circle estimate used by "matrix_mode": "estimate"
+estimate_speed_kph = float(os.getenv("MIO_ESTIMATE_SPEED_KPH", "40"))
+estimate_detour_factor = float(os.getenv("MIO_ESTIMATE_DETOUR_FACTOR", "1.3"))
+# Number of nearest neighbors requested per point by "matrix_mode": "sparse"
+sparse_neighbors = int(os.getenv("MIO_SPARSE_NEIGHBORS", "10"))
+# Number of solver strategies run in parallel processes by default, 0 or 1 solves in process
+solver_portfolio = int(os.getenv("MIO_SOLVER_PORTFOLIO", "0"))
+# Solves run off the event loop on MIO_SOLVER_WORKERS processes (MIO_SOLVER_EXECUTOR=process) or threads
+# (thread), with at most MIO_SOLVER_MAX_QUEUE more waiting. Requests beyond that are answered with 503
+solver_workers = int(os.getenv("MIO_SOLVER_WORKERS", str(os.cpu_count() or 1)))
+solver_executor = SolverExecutor(
+    kind=os.getenv("MIO_SOLVER_EXECUTOR", "process"),
+    workers=solver_workers,
+    max_queue=int(os.getenv("MIO_SOLVER_MAX_QUEUE", "4")),
+    # Each solver process gets its share of the cores for its portfolio or decomposition processes
+    initializer=limit_pool_workers,
+    initargs=((os.cpu_count() or 1) // max(1, solver_workers),)
+)
+# api/mio/stream sends the first improving plan, then at most one every MIO_STREAM_INTERVAL_SECONDS
+stream_interval_seconds = float(os.getenv("MIO_STREAM_INTERVAL_SECONDS", "0.1"))
+# Responses of the last MIO_SOLUTION_CACHE_SIZE distinct problems are kept MIO_SOLUTION_CACHE_TTL_SECONDS
+solution_cache = SolutionCache(
+    max_entries=int(os.getenv("MIO_SOLUTION_CACHE_SIZE", "256")),
+    ttl_seconds=int(os.getenv("MIO_SOLUTION_CACHE_TTL_SECONDS", "300"))
+)
+
+def get_matrix_cache():
+    """Returns the route matrix cache, opening it (and loading its sqlite file) on first use."""
+    global matrix_cache
+    if matrix_cache is None:
+        # MIO_MATRIX_CACHE_PATH optionally points to a sqlite file to keep the cells across restarts
+        matrix_cache = RouteMatrixCache(
+            path=os.getenv("MIO_MATRIX_CACHE_PATH"),
+            bucket_minutes=int(os.getenv("MIO_MATRIX_CACHE_BUCKET_MINUTES", "15")),
+            ttl_seconds=int(os.getenv("MIO_MATRIX_CACHE_TTL_SECONDS", str(24 * 3600))),
+            max_cells=int(os.getenv("MIO_MATRIX_CACHE_MAX_CELLS", "1000000"))
+        )
+    return matrix_cache
+
+def azure_maps_provider():
+    # API_KEY is the environment variable name for the Azure Maps API key which saved in Azure Function's Application Settings
+    # The matrix is fetched in tiles of at most MIO_MATRIX_MAX_CELLS cells, MIO_MATRIX_CONCURRENCY tiles at a time
+    # Matrices bigger than MIO_MATRIX_ASYNC_THRESHOLD cells are fetched as async jobs instead
+    api = AzureMapsApi(
+        api_key=os.getenv("API_KEY"),
+        base_url=os.getenv("MIO_AZURE_MAPS_URL", "https://atlas.microsoft.com")
+    )
+    return AzureMapsProvider(
+        api,
+        max_cells=int(os.getenv("MIO_MATRIX_MAX_CELLS", str(AzureMapsProvider.SYNC_MAX_CELLS))),
+        concurrency=int(os.getenv("MIO_MATRIX_CONCURRENCY", "8")),
+        async_threshold=int(os.getenv("MIO_MATRIX_ASYNC_THRESHOLD", "10000"))
+    )
+
+def bing_maps_provider():
+    # BME_KEY is the environment variable name for the Bing Maps API key
+    api = BingMapsApi(
+        api_key=os.getenv("BME_KEY"),
+        base_url=os.getenv("MIO_BING_MAPS_URL", "https://dev.virtualearth.net")
+    )
+    return BingMapsProvider(
+        api,
+        max_cells=int(os.getenv("MIO_BING_MATRIX_MAX_CELLS", str(BingMapsProvider.SYNC_MAX_CELLS))),
+        concurrency=int(os.getenv("MIO_MATRIX_CONCURRENCY", "8")),
+        async_threshold=int(os.getenv("MIO_MATRIX_ASYNC_THRESHOLD", "10000"))
+    )
+
+def matrix_provider():
+    # MIO_MATRIX_PROVIDER selects Azure Maps ("azure", the default), Bing Maps ("bing") or both ("hedged"):
+    # tiles still pending at Azure Maps after MIO_HEDGE_AFTER_SECONDS, or failed there, are sent to Bing Maps too
+    name = os.getenv("MIO_MATRIX_PROVIDER", "azure")
+    if name == "azure":
+        return azure_maps_provider()
+    if name == "bing":
+        return bing_maps_provider()
+    if name == "hedged":
+        return HedgedProvider(
+            azure_maps_provider(),
+            bing_maps_provider(),
+            hedge_after=float(os.getenv("MIO_HEDGE_AFTER_SECONDS", "2"))
+        )
+    raise ValueError(f"Error: Unknown MIO_MATRIX_PROVIDER {name}")
+
+async def provider_matrix(provider, all_points, num_starts, num_ends, neighbors=None, start_time=None):
+    """Returns the MatrixResult between all points (numbered starts, ends, waypoints) from the provider.
+
+    With neighbors set only the arcs to the nearest neighbors of every point are requested.
+    With start_time set the travel times are for a departure at that time (ISO 8601).
+    """
+    # No route leaves an end point or comes back to a start point, so only the rectangle
+    # (starts + waypoints) x (waypoints + ends) is requested, the other cells are never used
+    num_points = len(all_points)
+    waypoint_nodes = list(range(num_starts + num_ends, num_points))
+    origin_nodes = list(range(num_starts)) + waypoint_nodes
+    destination_nodes = waypoint_nodes + list(range(num_starts, num_starts + num_ends))
+    # Vehicles often share a depot, duplicated points are collapsed before calling the API
+    origins, origin_index = unique_points([all_points[i] for i in origin_nodes], coord_precision)
+    destinations, destination_index = unique_points([all_points[j] for j in destination_nodes], coord_precision)
+    logging.info(f"Route matrix {len(origin_nodes)}x{len(destination_nodes)} reduced to {len(origins)}x{len(destinations)} unique points")
+
+    # Cells already known from previous requests are served by the cache, only the missing pairs hit the API
+    # Identical requests already in flight (e.g. several dispatchers replanning the same depot) are joined
+    matrix_cache = get_matrix_cache()
+    matrix_key = matrix_cache.request_key(origins, destinations, travel_mode=provider.travel_mode, start_time=start_time or datetime.now())
+    if neighbors:
+        matrix_key += f":{neighbors}"
+        route_matrix = await matrix_flights.do(matrix_key, sparse_route_matrix, provider, matrix_cache, origins, destinations, neighbors, start_time)
+    else:
+        route_matrix = await matrix_flights.do(matrix_key, matrix_cache.route_matrix, provider, origins, destinations, start_time=start_time)
+    if not route_matrix.all_valid():
+        raise ValueError(f"Error: {provider.name} could not route between some of the points")
+
+    # Expand back to the index aligned matrix, the unused cells stay 0
+    result = MatrixResult.empty(num_points, num_points)
+    full = np.ix_(origin_nodes, destination_nodes)
+    unique = np.ix_(origin_index, destination_index)
+    result.durations[full] = route_matrix.durations[unique]
+    result.distances[full] = route_matrix.distances[unique]
+    result.valid[...] = True
+    return result
+
+def previous_routes(previous_plan, vehicles, waypoints, first_waypoint_node):
+    """Returns the waypoint nodes of every vehicle in previous_plan, unknown vehicles and waypoints are skipped."""
+    vehicle_index = {vehicle["id"]: i for i, vehicle in enumerate(vehicles)}
+    waypoint_node = {waypoint["id"]: first_waypoint_node + i for i, waypoint in enumerate(waypoints) if "id" in waypoint}
+    routes = [[] for _ in vehicles]
+    for plan in previous_plan:
+        if plan.get("id") not in vehicle_index:
+            continue
+        ids = plan.get("waypoints") or [location.get("id") for location in plan.get("locations", []) if isinstance(location, dict)]
+        routes[vehicle_index[plan["id"]]] = [waypoint_node[i] for i in ids if i in waypoint_node]
+    return routes
+
+async def mio(data: str, on_solution=None) -> (int, str):
+    """Returns (status code, response) for the json request data.
+
+    on_solution(locations, objective) is called with every improving plan (see optimizer()), from a
+    thread while the search runs. Returning True stops the search.
+    """
     try:
         data = json.loads(data)
     except (TypeError, ValueError) as ex:
@@ -27,11 +188,7 @@ async def mio(data: str) -> (int, str):
         return http.client.INTERNAL_SERVER_ERROR, msg
 
     try:
-        # API_KEY is the environment variable name for the Azure Maps API key which saved in Azure Function's Application Settings
-        api = AzureMapsApi(api_key=os.getenv("API_KEY"))
-
-        # Call Azure Maps Route Matrix API, which is used as input for the optimizer
-        # The route matrix requires all points (start, end, waypoints) to be in one string
+        # The optimizer numbers the points as starts, ends, waypoints
         vehicles = data.get("vehicles")
         vehicles_start = [vehicle["start"] for vehicle in vehicles]
         vehicles_end = [vehicle["end"] for vehicle in vehicles]
@@ -39,60 +196,163 @@ async def mio(data: str) -> (int, str):
         waypoints_location = [w['location'] for w in waypoints]
         all_points_full_info = vehicles_start + vehicles_end + waypoints
         all_points = vehicles_start + vehicles_end + waypoints_location
-        all_points_str = ";".join([f"{p[1]},{p[0]}" for p in all_points])
-        
-        api_rsp = await api.route_matrix(origins=all_points_str)
-
-        distance_matrix = [[None] * len(all_points) for i in range(len(all_points))]
-        if api_rsp["formatVersion"] == "0.0.1":
-            # In this demo we only use the major route and skip the alternative routes
-            # And we use the travelDuration as the distance/penalty between two points
-            azure_distance_matrix = api_rsp["matrix"]
-            row=0
-            col=0
-            for entry in azure_distance_matrix:
-                for value in entry:
-                    distance_matrix[row][col] = value["response"]["routeSummary"]["travelTimeInSeconds"]
-                    col += 1
-                row += 1
-                col = 0
+
+        # "matrix_mode": "estimate" builds the matrix locally from great-circle distances without calling
+        # Azure Maps, which is meant for what-if sizing, fleet count estimation and load tests
+        matrix_mode = data.get("matrix_mode", "provider")
+        departure_times = [None]
+        if matrix_mode == "estimate":
+            provider = EstimateProvider(
+                speed_kph=float(data.get("speed_kph", estimate_speed_kph)),
+                detour_factor=float(data.get("detour_factor", estimate_detour_factor))
+            )
+            matrices = [await provider.matrix(all_points, all_points)]
+        elif matrix_mode in ("provider", "sparse"):
+            # Call the route matrix provider (Azure Maps by default, see matrix_provider), which is used as input for the optimizer
+            # With "sparse" only the arcs to the "neighbors" closest points come from Azure Maps, the others are estimated
+            neighbors = int(data.get("neighbors", sparse_neighbors)) if matrix_mode == "sparse" else None
+            # With "departure_time" one matrix is fetched per "slice_minutes" slice over "horizon_minutes",
+            # the optimizer then uses, for every stop, the travel times of the slice the vehicle leaves it in
+            if data.get("departure_time"):
+                departure_time = datetime.fromisoformat(data["departure_time"])
+                slice_minutes = int(data.get("slice_minutes", 60))
+                num_slices = max(1, math.ceil(int(data.get("horizon_minutes", slice_minutes)) / slice_minutes))
+                departure_times = [(departure_time + timedelta(minutes=k * slice_minutes)).isoformat() for k in range(num_slices)]
+            provider = matrix_provider()
+            matrices = await asyncio.gather(*[
+                provider_matrix(provider, all_points, len(vehicles_start), len(vehicles_end), neighbors, start_time)
+                for start_time in departure_times
+            ])
         else:
-            raise ValueError(f"Error: Azure Maps API call failed:\n{api_rsp}")
+            return http.client.BAD_REQUEST, f"Error: Unknown matrix_mode {matrix_mode}"
 
-        logging.info(distance_matrix)
+        # Travel times (seconds) and distances (meters) both come from the same matrix call
+        time_matrix = matrices[0].durations.tolist()
+        distance_matrix = np.rint(matrices[0].distances).astype(np.int64).tolist()
+        logging.info(f"Route matrix {len(all_points)}x{len(all_points)}")
         # Call optimizer to get the optimized route
         input_body = {
+            "time_matrix": time_matrix,
             "distance_matrix" : distance_matrix,
             "num_vehicles": len(vehicles),
             "starts": [i for i in range(len(vehicles_start))],
             "ends": [i for i in range(len(vehicles_start), len(vehicles_start) + len(vehicles_end))]
         }
-        optimizer_result = optimizer(input_body)
-
-        output_response = []
-        for vehicle_index, sequence in optimizer_result.items():
-            output_item = {}
-            vehicle = vehicles[vehicle_index]
-            vehicle_id = vehicle["id"]
-            output_item["id"] = vehicle_id
-            output_item["locations"] = []
-            for index in sequence:
-                if index == sequence[0]:    # Start point
-                    location = all_points_full_info[index]
-                    output_item["locations"].append({"id": f"{vehicle_id}_start", "location": location})
-                elif index == sequence[-1]: # End point
-                    location = all_points_full_info[index]
-                    output_item["locations"].append({"id": f"{vehicle_id}_end", "location": location})
-                else:
-                    location = all_points_full_info[index]
-                    output_item["locations"].append(location)
-            output_response.append(output_item)
-
-        return http.client.OK, json.dumps(output_response)
+        # "search" optionally overrides the solver time limit, solution limit, strategies and stall time
+        # "previous_plan" lists, per vehicle id, the waypoint ids of an earlier plan ("waypoints"), or is the
+        # earlier response itself ("locations"). It is the starting point of the solver
+        if data.get("previous_plan"):
+            input_body["initial_routes"] = previous_routes(data["previous_plan"], vehicles, waypoints, len(vehicles_start) + len(vehicles_end))
+        search = dict(data.get("search") or {})
+        if solver_portfolio and "portfolio" not in search:
+            search["portfolio"] = solver_portfolio
+        if search:
+            input_body["search"] = search
+        # Waypoints with a "window" (e.g. a service day or a shift, in any sortable form) are planned one
+        # window after the other. With "carry_over" the vehicles continue from where they stopped
+        windows = sorted({w["window"] for w in waypoints if "window" in w})
+        if len(windows) > 1:
+            first_waypoint_node = len(vehicles_start) + len(vehicles_end)
+            input_body["windows"] = [[first_waypoint_node + i for i, w in enumerate(waypoints) if w.get("window", windows[0]) == window]
+                                     for window in windows]
+            input_body["carry_over"] = bool(data.get("carry_over", False))
+        if len(departure_times) > 1:
+            input_body["time_matrices"] = [matrix.durations.tolist() for matrix in matrices]
+            input_body["slice_seconds"] = slice_minutes * 60
+        # The search runs on the solver executor, so other requests keep being served meanwhile
+        if on_solution is None:
+            optimizer_result = await solver_executor.run(optimizer, input_body)
+        else:
+            def report(result, objective):
+                return on_solution(response_locations(result, vehicles, all_points_full_info), objective)
+            optimizer_result = await solver_executor.run(optimizer, input_body, on_solution=report)
+
+        return http.client.OK, json.dumps(response_locations(optimizer_result, vehicles, all_points_full_info))
+    except SolverBusyError as ex:
+        logging.warning(str(ex))
+        return http.client.SERVICE_UNAVAILABLE, str(ex)
     except Exception as ex:
         return http.client.INTERNAL_SERVER_ERROR, f"Error: Unhandled exception:\n{ex}"
 
 
+def response_locations(optimizer_result, vehicles, all_points_full_info):
+    """Turns the nodes of every vehicle returned by the optimizer into the response list of vehicle locations."""
+    output_response = []
+    for vehicle_index, sequence in optimizer_result.items():
+        if vehicle_index == "droppedNodes":
+            logging.warning(f"{len(sequence)} waypoints could not be served")
+            continue
+        output_item = {}
+        vehicle = vehicles[vehicle_index]
+        vehicle_id = vehicle["id"]
+        output_item["id"] = vehicle_id
+        output_item["locations"] = []
+        for index in sequence:
+            if index == sequence[0]:    # Start point
+                location = all_points_full_info[index]
+                output_item["locations"].append({"id": f"{vehicle_id}_start", "location": location})
+            elif index == sequence[-1]: # End point
+                location = all_points_full_info[index]
+                output_item["locations"].append({"id": f"{vehicle_id}_end", "location": location})
+            else:
+                location = all_points_full_info[index]
+                output_item["locations"].append(location)
+        output_response.append(output_item)
+
+    return output_response
+
+
+async def mio_stream(data: str):
+    """Runs mio(data) and yields NDJSON lines: {"objective", "elapsed", "result"} for the first and then
+    at most one improving plan every stream_interval_seconds, and {"status", "result", "final": true} last.
+
+    Closing the generator early (the client went away or has a good enough plan) stops the search at
+    its next improving solution.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    started = time.monotonic()
+    last_sent = [None]
+
+    def on_solution(result, objective):
+        now = time.monotonic()
+        if last_sent[0] is None or now - last_sent[0] >= stream_interval_seconds:
+            last_sent[0] = now
+            line = json.dumps({"objective": objective, "elapsed": round(now - started, 3), "result": result})
+            loop.call_soon_threadsafe(queue.put_nowait, line + "\n")
+        return stopped.is_set()
+
+    task = asyncio.ensure_future(mio(data, on_solution))
+    try:
+        while not task.done() or not queue.empty():
+            line = asyncio.ensure_future(queue.get())
+            await asyncio.wait({line, task}, return_when=asyncio.FIRST_COMPLETED)
+            if line.done():
+                yield line.result()
+            else:
+                line.cancel()
+        status_code, rsp = task.result()
+        result = json.loads(rsp) if status_code == http.client.OK else rsp
+        yield json.dumps({"status": status_code, "result": result, "final": True}) + "\n"
+    finally:
+        stopped.set()
+
+
+
+def solution_key(data):
+    """Solution cache key of the request body, None when caching is off or the body is not a json object."""
+    if solution_cache.max_entries <= 0:
+        return None
+    try:
+        problem = json.loads(data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(problem, dict):
+        return None
+    return SolutionCache.fingerprint(problem, {"provider": os.getenv("MIO_MATRIX_PROVIDER", "azure")})
+
+
 
 async def main(req: func.HttpRequest) -> func.HttpResponse:
     init_log()
@@ -105,7 +365,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
             # mio.html will call api/mio after clicking "Get Route" button
             contents = await f.read()
             return func.HttpResponse(contents, mimetype="text/html")
-    elif route_path == "api/mio":
+    elif route_path in ("api/mio", "api/mio/stream"):
         # Get GeoJSON either from query parameter "json" or from request body
         data = req.params.get("json")
         if data:
@@ -117,12 +377,25 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
                     raise ValueError("No json data in request")
             except ValueError:
                 logging.info("No json data in request, using test data")
-                data = test_data
+                data = test_data_path.read_text()
             except Exception as ex:
                 return func.HttpResponse(f"Error: Unhandled exception:\n{ex}", status_code=http.client.INTERNAL_SERVER_ERROR)
+        if route_path == "api/mio/stream":
+            # The Functions host sends an HttpResponse body once it is complete, so the lines arrive together
+            # here. A host which can stream (see examples/stream_server.py) sends every line as it comes
+            lines = [line async for line in mio_stream(data)]
+            return func.HttpResponse("".join(lines), mimetype="application/x-ndjson")
+        # Problems already solved are answered from the solution cache, without matrix call or solve
+        cache_key = solution_key(data)
+        cached = solution_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            logging.info(f"Solution cache hit {cache_key}")
+            return func.HttpResponse(cached, status_code=http.client.OK)
         status_code, rsp = await mio(data)
-        b = f'{{"status": {status_code}, "result": {rsp}}}'
-        json_rsp = json.loads(f'{{"status": {status_code}, "result": {rsp}}}')
+        # Errors are plain messages, only a solved request has a json result
+        json_rsp = {"status": status_code, "result": json.loads(rsp) if status_code == http.client.OK else rsp}
+        if cache_key and status_code == http.client.OK:
+            solution_cache.put(cache_key, json.dumps(dict(json_rsp, cache="hit"), indent=2))
         return func.HttpResponse(json.dumps(json_rsp, indent=2), status_code=status_code)
     else:
         return func.HttpResponse(None, status_code=http.client.NOT_FOUND)
\ No newline at end of file
@@ -1,48 +1,159 @@
 from datetime import datetime
-import aiohttp
+import asyncio
 import json
 import logging
+from urllib.parse import quote
+
+from mio.service.matrix_provider import MatrixProvider
+from mio.utils.http_session import get_session
 
 origins_list = []
 
+def points_to_str(points):
+    # Azure Maps expects "lat,lon" pairs while the request body uses [lon, lat]
+    return ";".join([f"{p[1]},{p[0]}" for p in points])
+
+def str_to_points(points_str):
+    points = []
+    for value in points_str.split(';'):
+        value_split = value.split(',')
+        points.append([float(value_split[1]), float(value_split[0])])
+    return points
+
+def read_route_matrix(api_rsp, out):
+    """Copies travelTimeInSeconds and lengthInMeters of every routed cell into out (a MatrixResult)."""
+    if api_rsp.get("formatVersion") != "0.0.1":
+        raise ValueError(f"Error: Azure Maps API call failed:\n{api_rsp}")
+
+    # In this demo we only use the major route and skip the alternative routes
+    for i, entry in enumerate(api_rsp["matrix"]):
+        for j, value in enumerate(entry):
+            if value.get("statusCode") == 200:
+                summary = value["response"]["routeSummary"]
+                out.durations[i, j] = summary["travelTimeInSeconds"]
+                out.distances[i, j] = summary["lengthInMeters"]
+                out.valid[i, j] = True
+
 class AzureMapsApi:
-    def __init__(self, api_key) -> None:
+    def __init__(self, api_key, base_url="https://atlas.microsoft.com",
+                 poll_interval=1.0, max_poll_interval=15.0, poll_timeout=600.0) -> None:
         self.travel_mode = "car"
         self.start_time = datetime.now().isoformat()
         self.time_unit = "second"
         if api_key is None:
             raise ValueError("Error: No api key provided")
         self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_timeout = poll_timeout
+
+    def matrix_body(self, origins, destinations):
+        origins_list = str_to_points(origins)
+        destinations_list = str_to_points(destinations) if destinations else origins_list
+        input_body = {
+            "origins": {
+                "type" : "MultiPoint",
+                "coordinates": origins_list,
+            },
+            "destinations": {
+                "type" : "MultiPoint",
+                "coordinates": destinations_list,
+            }
+        }
+        return json.dumps(input_body)
 
-    async def route_matrix(self, origins, travel_mode=None, start_time=None, time_unit=None):
-        origins_list = []
+    async def route_matrix(self, origins, destinations=None, travel_mode=None, start_time=None, time_unit=None):
         travel_mode = travel_mode or self.travel_mode
+        url = f"{self.base_url}/route/matrix/sync/json?api-version=1.0"\
+            f"&subscription-key={self.api_key}"\
+            f"&travelMode={travel_mode}"
+        # Only an explicit start time is sent, the construction time is already in the past for the service
+        if start_time:
+            url += f"&departAt={quote(start_time)}"
         start_time = start_time or self.start_time
         time_unit = time_unit or self.time_unit
-        url = f"https://atlas.microsoft.com/route/matrix/sync/json?api-version=1.0"\
+
+        logging.info("URL - "+url)
+        jsonBody = self.matrix_body(origins, destinations)
+        reqHeaders = {'content-type': 'application/json'}
+        async with get_session().post(url, data=jsonBody, headers=reqHeaders) as rsp:
+            result = await rsp.json()
+        return result
+
+    async def route_matrix_async(self, origins, destinations=None, travel_mode=None, start_time=None, time_unit=None):
+        """Submits an async route matrix job, polls it with exponential backoff and downloads the result."""
+        travel_mode = travel_mode or self.travel_mode
+        url = f"{self.base_url}/route/matrix/json?api-version=1.0"\
             f"&subscription-key={self.api_key}"\
             f"&travelMode={travel_mode}"
-        
+        if start_time:
+            url += f"&departAt={quote(start_time)}"
+
         logging.info("URL - "+url)
-        origins_split = origins.split(';')
-        for index,value in enumerate(origins_split):
-            value_split = value.split(',')
-            origin = []
-            origin.append(float(value_split[1]))
-            origin.append(float(value_split[0]))
-            origins_list.append(origin)
-
-        inner_body = {
-            "type" : "MultiPoint",
-            "coordinates": origins_list,
-        }
-        input_body = {
-            "origins": inner_body,
-            "destinations": inner_body
-        }
-        jsonBody = json.dumps(input_body)
+        jsonBody = self.matrix_body(origins, destinations)
         reqHeaders = {'content-type': 'application/json'}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=jsonBody, headers=reqHeaders) as rsp:
-                result = await rsp.json()
-        return result
\ No newline at end of file
+        session = get_session()
+        async with session.post(url, data=jsonBody, headers=reqHeaders) as rsp:
+            if rsp.status == 200:
+                return await rsp.json()
+            if rsp.status != 202 or "Location" not in rsp.headers:
+                raise ValueError(f"Error: Azure Maps API call failed:\n{await rsp.text()}")
+            location = rsp.headers["Location"]
+            retry_after = rsp.headers.get("Retry-After")
+
+        # The Location url does not carry the subscription key
+        if "subscription-key=" not in location:
+            location += ("&" if "?" in location else "?") + f"subscription-key={self.api_key}"
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.poll_timeout
+        delay = self.poll_interval
+        while True:
+            wait = float(retry_after) if retry_after else delay
+            if loop.time() + wait > deadline:
+                raise TimeoutError(f"Error: Azure Maps route matrix job did not complete in {self.poll_timeout} seconds")
+            await asyncio.sleep(wait)
+            async with session.get(location) as rsp:
+                if rsp.status == 200:
+                    return await rsp.json()
+                if rsp.status != 202:
+                    raise ValueError(f"Error: Azure Maps API call failed:\n{await rsp.text()}")
+                retry_after = rsp.headers.get("Retry-After")
+            delay = min(delay * 2, self.max_poll_interval)
+
+class AzureMapsProvider(MatrixProvider):
+    """Route matrix provider backed by the Azure Maps Route Matrix API.
+
+    Matrices with more cells than async_threshold are fetched with the async endpoint in tiles of
+    up to async_max_cells, the others with the sync endpoint in tiles of up to max_cells.
+    """
+    name = "azure"
+    # The sync route matrix endpoint accepts at most 100 cells (origins x destinations) per request,
+    # the async (job based) endpoint up to 700 cells
+    SYNC_MAX_CELLS = 100
+    ASYNC_MAX_CELLS = 700
+
+    def __init__(self, api, max_cells=SYNC_MAX_CELLS, concurrency=8, async_max_cells=ASYNC_MAX_CELLS, async_threshold=None) -> None:
+        super().__init__(max_cells=max_cells, concurrency=concurrency)
+        self.api = api
+        self.travel_mode = api.travel_mode
+        # None keeps everything on the sync endpoint
+        self.async_max_cells = async_max_cells
+        self.async_threshold = async_threshold
+
+    def use_async(self, num_cells):
+        return num_cells is not None and self.async_threshold is not None and num_cells > self.async_threshold
+
+    def tile_cells(self, num_cells):
+        return self.async_max_cells if self.use_async(num_cells) else self.max_cells
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        route_matrix = self.api.route_matrix_async if self.use_async(num_cells) else self.api.route_matrix
+        api_rsp = await route_matrix(
+            origins=points_to_str(origins),
+            destinations=points_to_str(destinations),
+            travel_mode=self.travel_mode,
+            start_time=start_time
+        )
+        read_route_matrix(api_rsp, out)
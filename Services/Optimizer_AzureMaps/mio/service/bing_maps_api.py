@@ -0,0 +1,157 @@
+from datetime import datetime
+import json
+import asyncio
+
+from mio.service.matrix_provider import MatrixProvider
+from mio.utils.http_session import get_session
+
+def str_to_points(points_str):
+    points = []
+    for value in points_str.split(';'):
+        value_split = value.split(',')
+        points.append([float(value_split[1]), float(value_split[0])])
+    return points
+
+def matrix_results(bing_rsp):
+    """Returns the results list of a sync distance matrix response or of an async job result."""
+    if "results" in bing_rsp:
+        return bing_rsp["results"]
+    if bing_rsp.get("statusCode") == 200:
+        return bing_rsp["resourceSets"][0]["resources"][0]["results"]
+    raise ValueError(f"Error: Bing Maps API call failed:\n{bing_rsp}")
+
+def read_distance_matrix(bing_rsp, out):
+    """Copies travelDuration and travelDistance of every routed cell into out (a MatrixResult)."""
+    for entry in matrix_results(bing_rsp):
+        # travelDuration is -1 when no route was found, the optimizer works on whole units
+        if entry.get("travelDuration", -1) >= 0:
+            i, j = entry["originIndex"], entry["destinationIndex"]
+            out.durations[i, j] = round(entry["travelDuration"])
+            # travelDistance is in kilometers (the default distanceUnit)
+            out.distances[i, j] = entry.get("travelDistance", 0) * 1000
+            out.valid[i, j] = True
+
+class BingMapsApi:
+    def __init__(self, api_key, base_url="https://dev.virtualearth.net",
+                 poll_interval=1.0, max_poll_interval=15.0, poll_timeout=600.0) -> None:
+        self.travel_mode = "driving"
+        self.start_time = datetime.now().isoformat()
+        self.time_unit = "second"
+        if api_key is None:
+            raise ValueError("Error: No api key provided")
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_timeout = poll_timeout
+
+    def matrix_body(self, origins, destinations, travel_mode, start_time, time_unit):
+        # origins and destinations are lists of [lon, lat] or the legacy "lat,lon;lat,lon" string
+        if isinstance(origins, str):
+            origins = str_to_points(origins)
+        if isinstance(destinations, str):
+            destinations = str_to_points(destinations)
+        destinations = destinations or origins
+        input_body = {
+            "origins": [{"latitude": p[1], "longitude": p[0]} for p in origins],
+            "destinations": [{"latitude": p[1], "longitude": p[0]} for p in destinations],
+            "travelMode": travel_mode,
+            "startTime": start_time,
+            "timeUnit": time_unit
+        }
+        return json.dumps(input_body)
+
+    async def distance_matrix(self, origins, destinations=None, travel_mode=None, start_time=None, time_unit=None):
+        travel_mode = travel_mode or self.travel_mode
+        start_time = start_time or self.start_time
+        time_unit = time_unit or self.time_unit
+        # The coordinates go in a POST body, a GET query string hits the url length limit long before the cell limit
+        url = f"{self.base_url}/REST/v1/Routes/DistanceMatrix"\
+              f"?key={self.api_key}"
+        jsonBody = self.matrix_body(origins, destinations, travel_mode, start_time, time_unit)
+        reqHeaders = {'content-type': 'application/json'}
+        async with get_session().post(url, data=jsonBody, headers=reqHeaders) as rsp:
+            result = await rsp.json()
+        return result
+
+    async def distance_matrix_async(self, origins, destinations=None, travel_mode=None, start_time=None, time_unit=None):
+        """Submits a DistanceMatrixAsync job, polls it until completed and downloads the result."""
+        travel_mode = travel_mode or self.travel_mode
+        start_time = start_time or self.start_time
+        time_unit = time_unit or self.time_unit
+        url = f"{self.base_url}/REST/v1/Routes/DistanceMatrixAsync"\
+              f"?key={self.api_key}"
+        jsonBody = self.matrix_body(origins, destinations, travel_mode, start_time, time_unit)
+        reqHeaders = {'content-type': 'application/json'}
+        session = get_session()
+        async with session.post(url, data=jsonBody, headers=reqHeaders) as rsp:
+            bing_rsp = await rsp.json()
+        if bing_rsp.get("statusCode") not in (200, 202):
+            raise ValueError(f"Error: Bing Maps API call failed:\n{bing_rsp}")
+        job = bing_rsp["resourceSets"][0]["resources"][0]
+        request_id = job["requestId"]
+        status_url = f"{self.base_url}/REST/v1/Routes/DistanceMatrixAsyncCallback"\
+                     f"?requestId={request_id}"\
+                     f"&key={self.api_key}"
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.poll_timeout
+        delay = self.poll_interval
+        while not job.get("isCompleted"):
+            if job.get("errorMessage"):
+                raise ValueError(f"Error: Bing Maps distance matrix job failed:\n{job['errorMessage']}")
+            # callbackInterval is the wait suggested by the service, in seconds
+            wait = float(job.get("callbackInterval") or delay)
+            if loop.time() + wait > deadline:
+                raise TimeoutError(f"Error: Bing Maps distance matrix job did not complete in {self.poll_timeout} seconds")
+            await asyncio.sleep(wait)
+            async with session.get(status_url) as rsp:
+                bing_rsp = await rsp.json()
+            if bing_rsp.get("statusCode") != 200:
+                raise ValueError(f"Error: Bing Maps API call failed:\n{bing_rsp}")
+            job = bing_rsp["resourceSets"][0]["resources"][0]
+            delay = min(delay * 2, self.max_poll_interval)
+
+        # resultUrl is a signed blob storage url, it is downloaded as is
+        async with session.get(job["resultUrl"]) as rsp:
+            result = await rsp.json(content_type=None)
+        return result
+
+class BingMapsProvider(MatrixProvider):
+    """Route matrix provider backed by the Bing Maps Distance Matrix API.
+
+    Matrices with more cells than async_threshold are fetched as DistanceMatrixAsync jobs in
+    chunks of up to async_max_cells, the others with sync requests of up to max_cells.
+    """
+    name = "bing"
+    # A sync distance matrix request accepts at most 2500 cells (origins x destinations),
+    # a DistanceMatrixAsync job up to 62500
+    SYNC_MAX_CELLS = 2500
+    ASYNC_MAX_CELLS = 62500
+
+    def __init__(self, api, max_cells=SYNC_MAX_CELLS, concurrency=8, async_max_cells=ASYNC_MAX_CELLS, async_threshold=None) -> None:
+        super().__init__(max_cells=max_cells, concurrency=concurrency)
+        self.api = api
+        self.travel_mode = api.travel_mode
+        # None keeps everything on sync requests
+        self.async_max_cells = async_max_cells
+        self.async_threshold = async_threshold
+
+    def use_async(self, num_cells):
+        return num_cells is not None and self.async_threshold is not None and num_cells > self.async_threshold
+
+    def tile_cells(self, num_cells):
+        return self.async_max_cells if self.use_async(num_cells) else self.max_cells
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        # A job costs a submit, polls and a download, chunks which fit a sync request (e.g. the tiles of
+        # HedgedProvider, sized for Azure Maps) are sent as one
+        use_async = self.use_async(num_cells) and len(origins) * len(destinations) > self.max_cells
+        distance_matrix = self.api.distance_matrix_async if use_async else self.api.distance_matrix
+        bing_rsp = await distance_matrix(
+            origins=origins,
+            destinations=destinations,
+            travel_mode=self.travel_mode,
+            start_time=start_time
+        )
+        read_distance_matrix(bing_rsp, out)
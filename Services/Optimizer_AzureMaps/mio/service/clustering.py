@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+
+# Every cluster may take this many times its even share of the waypoints
+CLUSTER_CAPACITY_SLACK = 1.2
+# k-medoids passes, the medoids are usually stable after a handful
+CLUSTER_ITERATIONS = 10
+
+
+def balanced_assignment(cost, capacity):
+    """Assigns every column (waypoint) of cost to a row (cluster) with at most capacity columns per row.
+
+    Cheapest pairs first, a waypoint whose closest clusters are full goes to the closest one with room.
+    Returns the cluster of every waypoint.
+    """
+    num_clusters, num_waypoints = cost.shape
+    assignment = np.full(num_waypoints, -1, dtype=np.int64)
+    sizes = np.zeros(num_clusters, dtype=np.int64)
+    for flat in np.argsort(cost, axis=None, kind="stable").tolist():
+        cluster, waypoint = divmod(flat, num_waypoints)
+        if assignment[waypoint] < 0 and sizes[cluster] < capacity:
+            assignment[waypoint] = cluster
+            sizes[cluster] += 1
+    return assignment
+
+
+def medoid(distance_matrix, members):
+    """The member with the smallest round trip distance to all the others."""
+    within = np.asarray(distance_matrix)[np.ix_(members, members)]
+    return int(members[int((within.sum(axis=0) + within.sum(axis=1)).argmin())])
+
+
+def cluster_waypoints(distance_matrix, starts, waypoints):
+    """Splits waypoints into one cluster per vehicle, seeded at the vehicle starts.
+
+    Capacitated k-medoids on the round trip distances: the waypoints are assigned to the closest
+    medoid with room left, then every medoid moves to the member closest to the rest of its
+    cluster, until the medoids stop moving. Returns (the waypoints of every cluster, the medoids).
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=np.int64)
+    num_clusters = len(starts)
+    capacity = math.ceil(len(waypoints) / num_clusters * CLUSTER_CAPACITY_SLACK)
+    waypoints = np.asarray(waypoints, dtype=np.int64)
+    medoids = list(starts)
+    for _ in range(CLUSTER_ITERATIONS):
+        cost = distance_matrix[np.ix_(medoids, waypoints)] + distance_matrix[np.ix_(waypoints, medoids)].T
+        assignment = balanced_assignment(cost, capacity)
+        moved = []
+        for cluster, center in enumerate(medoids):
+            members = waypoints[assignment == cluster]
+            moved.append(medoid(distance_matrix, members) if len(members) else center)
+        if moved == medoids:
+            break
+        medoids = moved
+    return [waypoints[assignment == cluster].tolist() for cluster in range(num_clusters)], medoids
+
+
+def border_pairs(distance_matrix, medoids, rank):
+    """Disjoint pairs of clusters sharing a border, each cluster with its rank-th closest cluster (0 = closest).
+
+    Closest pairs are taken first, a cluster already paired in the round waits for the next one.
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=np.int64)
+    between = distance_matrix[np.ix_(medoids, medoids)]
+    between = between + between.T
+    np.fill_diagonal(between, np.iinfo(np.int64).max)
+    candidates = set()
+    for cluster in range(len(medoids)):
+        order = np.argsort(between[cluster], kind="stable")
+        if rank < len(medoids) - 1:
+            other = int(order[rank])
+            candidates.add((min(cluster, other), max(cluster, other)))
+    pairs = []
+    paired = set()
+    for a, b in sorted(candidates, key=lambda pair: between[pair]):
+        if a not in paired and b not in paired:
+            pairs.append((a, b))
+            paired.update((a, b))
+    return pairs
@@ -0,0 +1,136 @@
+import numpy as np
+
+# Largest instances solved exactly instead of with the OR-Tools search
+EXACT_MAX_WAYPOINTS_SINGLE = 10
+EXACT_MAX_WAYPOINTS_FLEET = 7
+EXACT_MAX_VEHICLES = 3
+
+
+def held_karp(cost, start, end, waypoints):
+    """Cheapest path from start through all waypoints to end on the additive cost matrix.
+
+    Bitmask dynamic programming, vectorized over the subsets. Returns (cost, ordered waypoints).
+    """
+    n = len(waypoints)
+    if n == 0:
+        return 0, []
+    between = cost[np.ix_(waypoints, waypoints)]
+    masks = np.arange(1 << n)
+    best = np.full((1 << n, n), np.iinfo(np.int64).max // 4, dtype=np.int64)
+    parent = np.full((1 << n, n), -1, dtype=np.int64)
+    for j in range(n):
+        best[1 << j, j] = cost[start, waypoints[j]]
+
+    # After k passes every path through k + 1 waypoints is final
+    for _ in range(n - 1):
+        extended = best[:, :, None] + between[None, :, :]
+        from_nodes = extended.argmin(axis=1)
+        extended = np.take_along_axis(extended, from_nodes[:, None, :], axis=1)[:, 0, :]
+        for j in range(n):
+            sources = masks[(masks & (1 << j)) == 0]
+            targets = sources | (1 << j)
+            better = extended[sources, j] < best[targets, j]
+            best[targets[better], j] = extended[sources[better], j]
+            parent[targets[better], j] = from_nodes[sources[better], j]
+
+    full = (1 << n) - 1
+    totals = best[full] + cost[waypoints, end]
+    last = int(totals.argmin())
+    route = []
+    mask = full
+    while last >= 0:
+        route.append(waypoints[last])
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    return int(totals.min()), route[::-1]
+
+
+def add_to_front(front, label):
+    """Adds label (time, distance, ...) to the Pareto front of (time, distance) unless it is dominated."""
+    for other in front:
+        if other[0] <= label[0] and other[1] <= label[1]:
+            return
+    front[:] = [other for other in front if not (label[0] <= other[0] and label[1] <= other[1])]
+    front.append(label)
+
+
+def route_fronts(time_matrix, distance_matrix, start, end, waypoints, max_distance):
+    """Returns, for every subset (bitmask) of waypoints, the Pareto front of the routes from start
+    through exactly that subset to end, as (travel time, distance, ordered waypoints) labels."""
+    n = len(waypoints)
+    labels = {}
+    for j, node in enumerate(waypoints):
+        labels[(1 << j, j)] = [(time_matrix[start][node], distance_matrix[start][node], (node,))]
+    # Like in the OR-Tools model an unused vehicle costs nothing and does not count in the span
+    fronts = {0: [(0, 0, ())]}
+    # A subset is always numerically larger than its parts, so increasing masks are final when extended
+    for mask in range(1, 1 << n):
+        front = fronts.setdefault(mask, [])
+        for last in range(n):
+            for time, distance, route in labels.get((mask, last), ()):
+                node = waypoints[last]
+                closed = distance + distance_matrix[node][end]
+                if closed <= max_distance:
+                    add_to_front(front, (time + time_matrix[node][end], closed, route))
+                for j in range(n):
+                    if not mask & (1 << j):
+                        nxt = waypoints[j]
+                        add_to_front(labels.setdefault((mask | (1 << j), j), []),
+                                     (time + time_matrix[node][nxt], distance + distance_matrix[node][nxt], route + (nxt,)))
+    return fronts
+
+
+def exact_routes(data, span_cost_coefficient, max_distance):
+    """Optimal routes for a tiny instance, or None when it is not tiny or has no feasible solution.
+
+    The objective is the one of the OR-Tools model: the arc costs (travel times, or distances
+    without a time_matrix) plus span_cost_coefficient times the longest route distance, with
+    every route within max_distance. Returns (objective, waypoints of every vehicle).
+    """
+    num_vehicles = data["num_vehicles"]
+    starts, ends = data["starts"], data["ends"]
+    distance_matrix = data["distance_matrix"]
+    time_matrix = data.get("time_matrix") or distance_matrix
+    fixed = set(starts) | set(ends)
+    waypoints = [node for node in range(len(distance_matrix)) if node not in fixed]
+
+    if num_vehicles == 1 and len(waypoints) <= EXACT_MAX_WAYPOINTS_SINGLE:
+        # With one route the span is its distance, so the objective is additive over the arcs
+        cost = np.asarray(time_matrix, dtype=np.int64) + span_cost_coefficient * np.asarray(distance_matrix, dtype=np.int64)
+        objective, route = held_karp(cost, starts[0], ends[0], waypoints)
+        nodes = [starts[0]] + route + [ends[0]]
+        if sum(distance_matrix[a][b] for a, b in zip(nodes, nodes[1:])) > max_distance:
+            return None
+        return objective, [route]
+
+    if num_vehicles > EXACT_MAX_VEHICLES or len(waypoints) > EXACT_MAX_WAYPOINTS_FLEET:
+        return None
+
+    # The span (longest route) is not additive, so every vehicle keeps the Pareto front of
+    # (travel time, distance) per subset and the fronts are combined over all the assignments
+    full = (1 << len(waypoints)) - 1
+    combined = None
+    for vehicle in range(num_vehicles):
+        fronts = route_fronts(time_matrix, distance_matrix, starts[vehicle], ends[vehicle], waypoints, max_distance)
+        if combined is None:
+            combined = {mask: [(time, distance, (route,)) for time, distance, route in front] for mask, front in fronts.items()}
+            continue
+        # Only the full set is needed after the last vehicle
+        masks = [full] if vehicle == num_vehicles - 1 else range(full + 1)
+        merged = {}
+        for mask in masks:
+            front = merged.setdefault(mask, [])
+            sub = mask
+            while True:
+                for time, distance, routes in combined.get(mask ^ sub, ()):
+                    for route_time, route_distance, route in fronts.get(sub, ()):
+                        add_to_front(front, (time + route_time, max(distance, route_distance), routes + (route,)))
+                if sub == 0:
+                    break
+                sub = (sub - 1) & mask
+        combined = merged
+
+    solutions = combined.get(full, [])
+    if not solutions:
+        return None
+    time, distance, routes = min(solutions, key=lambda label: label[0] + span_cost_coefficient * label[1])
+    return time + span_cost_coefficient * distance, [list(route) for route in routes]
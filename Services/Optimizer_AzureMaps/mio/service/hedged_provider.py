@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+from mio.service.matrix_provider import MatrixProvider, MatrixResult
+
+class HedgedProvider(MatrixProvider):
+    """Fetches every tile from primary and hedges slow or failed tiles with secondary.
+
+    When primary has not answered a tile after hedge_after seconds the same tile is also
+    requested from secondary and whichever completes first is used, the other request is
+    cancelled. When one of them fails (an error, a 429, a timeout) the other one is waited for.
+    Tiles are sized so they are valid requests for both providers.
+    """
+    name = "hedged"
+
+    def __init__(self, primary, secondary, hedge_after=2.0, concurrency=None) -> None:
+        super().__init__(
+            max_cells=min(primary.max_cells, secondary.max_cells),
+            concurrency=concurrency or max(primary.concurrency, secondary.concurrency)
+        )
+        self.primary = primary
+        self.secondary = secondary
+        self.hedge_after = hedge_after
+        # Cached cells are keyed on the travel mode of the primary whichever provider answered
+        self.travel_mode = primary.travel_mode
+        self.stats = {"tiles": 0, "hedged": 0, "failovers": 0, primary.name: 0, secondary.name: 0}
+
+    def tile_cells(self, num_cells):
+        return min(self.primary.tile_cells(num_cells), self.secondary.tile_cells(num_cells))
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        self.stats["tiles"] += 1
+
+        async def fetch(provider):
+            # Each provider writes into its own arrays, only the winner is copied into out
+            result = MatrixResult.empty(len(origins), len(destinations))
+            await provider.fetch_tile(origins, destinations, result, start_time, num_cells)
+            return provider, result
+
+        pending = {asyncio.ensure_future(fetch(self.primary))}
+        failed = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after)
+            if done:
+                task = done.pop()
+                if task.exception() is None:
+                    return self.use(task.result(), out)
+                failed = task.exception()
+                self.stats["failovers"] += 1
+                logging.warning(f"{self.primary.name} matrix tile failed, failing over to {self.secondary.name}: {failed}")
+            else:
+                self.stats["hedged"] += 1
+                logging.info(f"{self.primary.name} matrix tile slower than {self.hedge_after}s, hedging with {self.secondary.name}")
+            pending.add(asyncio.ensure_future(fetch(self.secondary)))
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return self.use(task.result(), out)
+                    failed = task.exception()
+                    if pending:
+                        self.stats["failovers"] += 1
+                        logging.warning(f"Matrix tile failed, waiting for the other provider: {failed}")
+            raise failed
+        finally:
+            # The slower request is not needed any more
+            for task in pending:
+                task.cancel()
+
+    def use(self, fetched, out):
+        provider, result = fetched
+        self.stats[provider.name] += 1
+        out.durations[...] = result.durations
+        out.distances[...] = result.distances
+        out.valid[...] = result.valid
@@ -0,0 +1,317 @@
+import time
+import json
+import asyncio
+import hashlib
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from mio.service.matrix_provider import MatrixResult
+
+def missing_blocks(missing):
+    """Groups the missing cells (True in the boolean array) into at most two (rows, cols) rectangles.
+
+    Rows with no cached cell at all (new origins) are fetched against every missing column,
+    the remaining rows only against the columns they miss (new destinations), so adding one
+    point to a cached request costs about 2N cells instead of N².
+    """
+    missing_cols = np.flatnonzero(missing.any(axis=0))
+    if not len(missing_cols):
+        return []
+    new_rows_mask = missing[:, missing_cols].all(axis=1)
+    new_rows = np.flatnonzero(new_rows_mask)
+    other_rows = np.flatnonzero(~new_rows_mask & missing.any(axis=1))
+    blocks = []
+    if len(new_rows):
+        blocks.append((new_rows.tolist(), missing_cols.tolist()))
+    if len(other_rows):
+        other_cols = np.flatnonzero(missing[other_rows].any(axis=0))
+        blocks.append((other_rows.tolist(), other_cols.tolist()))
+    return blocks
+
+class RouteMatrixCache:
+    """Pairwise travel time and distance cache which sits in front of a MatrixProvider.
+
+    Cells are keyed by (origin, destination, travel mode, departure time bucket), the bucket being
+    the day type (weekday or weekend) and the time of day, so the same depots are reused from one
+    day to the next. Only the origin/destination pairs missing from the cache are requested from
+    the provider. At most max_cells cells are kept, the least recently used go first. When a path
+    is given the cells are also written to a sqlite file so they survive a restart of the Function host.
+    """
+    # A cell key packs (travel mode and bucket, origin id, destination id) into one int64
+    POINT_BITS = 24
+    SLOT_BITS = 63 - 2 * POINT_BITS
+    # The point ids are renumbered once this many were handed out, see compact_ids()
+    MIN_COMPACT_POINTS = 1 << 16
+
+    def __init__(self, path=None, bucket_minutes=15, ttl_seconds=24 * 3600, precision=6, max_cells=1_000_000) -> None:
+        self.path = path
+        self.bucket_minutes = bucket_minutes
+        self.ttl_seconds = ttl_seconds
+        self.precision = precision
+        self.max_cells = max_cells
+        self.point_ids = {}     # rounded point key -> id
+        self.point_keys = []    # id -> rounded point key
+        self.slot_ids = {}      # (travel mode, bucket) -> id
+        self.slot_keys = []     # id -> (travel mode, bucket)
+        # Cells sorted by key, with their travel time in seconds, length in meters, expiry and last use timestamps
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.durations = np.zeros(0, dtype=np.int32)
+        self.distances = np.zeros(0, dtype=np.float32)
+        self.expires = np.zeros(0, dtype=np.float64)
+        self.used = np.zeros(0, dtype=np.float64)
+        self.compact_at = self.MIN_COMPACT_POINTS
+        self.db = None
+        self.db_writer = None
+        if path:
+            # The writes run on their own thread (see save()), one at a time
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="matrix-cache")
+            self.db.execute("CREATE TABLE IF NOT EXISTS route_matrix_cells "
+                            "(key TEXT PRIMARY KEY, travel_time INTEGER, length REAL, expires_at REAL)")
+            now = time.time()
+            self.db.execute("DELETE FROM route_matrix_cells WHERE expires_at <= ?", (now,))
+            self.db.commit()
+            rows = self.db.execute("SELECT key, travel_time, length, expires_at FROM route_matrix_cells "
+                                   "ORDER BY expires_at DESC LIMIT ?", (max_cells,)).fetchall()
+            keys = []
+            for key, _, _, _ in rows:
+                origin, destination, travel_mode, bucket = key.split("|")
+                keys.append(self.cell_key(self.point_id(origin), self.point_id(destination), self.slot_id(travel_mode, bucket)))
+            self.insert(np.array(keys, dtype=np.int64),
+                        np.array([row[1] for row in rows], dtype=np.int32),
+                        np.array([row[2] for row in rows], dtype=np.float32),
+                        np.array([row[3] for row in rows], dtype=np.float64), now)
+            logging.info(f"Route matrix cache loaded {len(self.keys)} cells from {path}")
+
+    def bucket(self, start_time):
+        # The time of day rounded down to the bucket, on a weekday or a weekend day, so requests a few
+        # minutes apart and the same plan on the next working day share cells
+        if isinstance(start_time, str):
+            start_time = datetime.fromisoformat(start_time)
+        minute = start_time.hour * 60 + start_time.minute
+        minute -= minute % self.bucket_minutes
+        day_type = "weekend" if start_time.weekday() >= 5 else "weekday"
+        return f"{day_type} {minute // 60:02d}:{minute % 60:02d}"
+
+    def point_key(self, point):
+        return f"{round(point[0], self.precision)},{round(point[1], self.precision)}"
+
+    def point_id(self, point_key):
+        point_id = self.point_ids.get(point_key)
+        if point_id is None:
+            point_id = len(self.point_keys)
+            # A larger id would overlap the origin bits of the cell key and return another pair
+            if point_id >= 1 << self.POINT_BITS:
+                raise OverflowError(f"Error: Route matrix cache has more than {1 << self.POINT_BITS} points")
+            self.point_ids[point_key] = point_id
+            self.point_keys.append(point_key)
+        return point_id
+
+    def slot_id(self, travel_mode, bucket):
+        # At most two day types times the buckets of a day per travel mode, never renumbered
+        slot = (travel_mode, bucket)
+        slot_id = self.slot_ids.get(slot)
+        if slot_id is None:
+            slot_id = len(self.slot_keys)
+            if slot_id >= 1 << self.SLOT_BITS:
+                raise OverflowError(f"Error: Route matrix cache has more than {1 << self.SLOT_BITS} time buckets")
+            self.slot_ids[slot] = slot_id
+            self.slot_keys.append(slot)
+        return slot_id
+
+    def compact_ids(self, now):
+        """Renumbers the points of the live cells from 0 once compact_at ids were handed out.
+
+        The ids of evicted and expired points are freed, so the id table follows the cached cells
+        instead of every point seen by the host. Keys computed before a call are stale after it,
+        callers compute them again after every await.
+        """
+        if len(self.point_keys) < self.compact_at:
+            return
+        self.prune(now)
+        point_mask = (1 << self.POINT_BITS) - 1
+        ends = np.concatenate([(self.keys >> self.POINT_BITS) & point_mask, self.keys & point_mask])
+        live_ids, new_ids = np.unique(ends, return_inverse=True)
+        self.point_keys = [self.point_keys[i] for i in live_ids.tolist()]
+        self.point_ids = {point_key: i for i, point_key in enumerate(self.point_keys)}
+        keys = self.cell_key(new_ids[:len(self.keys)], new_ids[len(self.keys):], self.keys >> (2 * self.POINT_BITS))
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.durations, self.distances, self.expires, self.used = (
+            keys[order], self.durations[order], self.distances[order], self.expires[order], self.used[order])
+        self.compact_at = max(self.MIN_COMPACT_POINTS, 2 * len(self.point_keys))
+        logging.info(f"Route matrix cache renumbered {len(self.point_keys)} points of {len(self.keys)} cells")
+
+    def cell_key(self, origin_ids, destination_ids, slot_id):
+        return (np.int64(slot_id) << (2 * self.POINT_BITS)) | (np.asarray(origin_ids, dtype=np.int64) << self.POINT_BITS) | np.asarray(destination_ids, dtype=np.int64)
+
+    def ids(self, points):
+        return np.array([self.point_id(self.point_key(p)) for p in points], dtype=np.int64)
+
+    def request_key(self, origins, destinations=None, travel_mode=None, start_time=None):
+        """Canonical hash of a matrix request: the rounded points, travel mode and departure time bucket."""
+        request = {
+            "origins": [self.point_key(p) for p in origins],
+            "destinations": None if destinations is None else [self.point_key(p) for p in destinations],
+            "travel_mode": travel_mode,
+            "bucket": self.bucket(start_time) if start_time else None
+        }
+        return hashlib.sha256(json.dumps(request, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def find(self, keys, now):
+        """Index of every key in the cells, -1 when it is missing or expired."""
+        if not len(self.keys):
+            return np.full(keys.shape, -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where((self.keys[index] == keys) & (self.expires[index] > now), index, -1)
+
+    def prune(self, now):
+        """Drops the expired cells."""
+        live = self.expires > now
+        if not live.all():
+            self.keys, self.durations, self.distances, self.expires, self.used = (
+                self.keys[live], self.durations[live], self.distances[live], self.expires[live], self.used[live])
+
+    def insert(self, keys, durations, distances, expires, now):
+        """Adds (or replaces) cells, drops the expired ones and evicts the least recently used beyond max_cells.
+        Returns whether cells were evicted."""
+        self.prune(now)
+        keys, first = np.unique(keys, return_index=True)
+        durations, distances, expires = durations[first], distances[first], expires[first]
+        # Cached cells are updated in place, the new ones are merged into the sorted arrays
+        index = self.find(keys, now)
+        found = index >= 0
+        self.durations[index[found]] = durations[found]
+        self.distances[index[found]] = distances[found]
+        self.expires[index[found]] = expires[found]
+        self.used[index[found]] = now
+        new = ~found
+        position = np.searchsorted(self.keys, keys[new])
+        self.keys = np.insert(self.keys, position, keys[new])
+        self.durations = np.insert(self.durations, position, durations[new])
+        self.distances = np.insert(self.distances, position, distances[new])
+        self.expires = np.insert(self.expires, position, expires[new])
+        self.used = np.insert(self.used, position, now)
+        evicted = len(self.keys) > self.max_cells
+        if evicted:
+            # A tenth more than needed goes at once, so that the next writes do not evict again
+            excess = min(len(self.keys), len(self.keys) - self.max_cells + self.max_cells // 10)
+            keep = np.ones(len(self.keys), dtype=bool)
+            keep[np.argpartition(self.used, excess - 1)[:excess]] = False
+            self.keys, self.durations, self.distances, self.expires, self.used = (
+                self.keys[keep], self.durations[keep], self.distances[keep], self.expires[keep], self.used[keep])
+        return evicted
+
+    def lookup(self, keys, result, now):
+        index = self.find(keys, now)
+        hit = index >= 0
+        result.durations[hit] = self.durations[index[hit]]
+        result.distances[hit] = self.distances[index[hit]]
+        result.valid[hit] = True
+        self.used[index[hit]] = now
+
+    async def store(self, keys, result, mask, now):
+        # Only the routed cells selected by mask (the ones just fetched) are written
+        selected = mask & result.valid
+        await self.save(keys[selected], result.durations[selected], result.distances[selected], now)
+
+    async def save(self, keys, durations, distances, now):
+        if not len(keys):
+            return
+        expires_at = now + self.ttl_seconds
+        evicted = self.insert(keys, durations, distances, np.full(len(keys), expires_at), now)
+        if self.db is not None:
+            # The id tables are only appended to until compact_ids() replaces them, so the thread can read them
+            await asyncio.get_running_loop().run_in_executor(
+                self.db_writer, self.write, keys, durations, distances, expires_at, now, evicted, self.point_keys, self.slot_keys)
+
+    def write(self, keys, durations, distances, expires_at, now, evicted, point_keys, slot_keys):
+        """Writes cells to the sqlite file, on the writer thread."""
+        point_mask = (1 << self.POINT_BITS) - 1
+        rows = []
+        for key, travel_time, length in zip(keys.tolist(), durations.tolist(), distances.tolist()):
+            travel_mode, bucket = slot_keys[key >> (2 * self.POINT_BITS)]
+            origin, destination = point_keys[(key >> self.POINT_BITS) & point_mask], point_keys[key & point_mask]
+            rows.append((f"{origin}|{destination}|{travel_mode}|{bucket}", travel_time, length, expires_at))
+        self.db.executemany("INSERT OR REPLACE INTO route_matrix_cells (key, travel_time, length, expires_at) VALUES (?, ?, ?, ?)", rows)
+        self.db.execute("DELETE FROM route_matrix_cells WHERE expires_at <= ?", (now,))
+        if evicted:
+            self.db.execute("DELETE FROM route_matrix_cells WHERE key NOT IN "
+                            "(SELECT key FROM route_matrix_cells ORDER BY expires_at DESC LIMIT ?)", (self.max_cells,))
+        self.db.commit()
+
+    async def route_matrix(self, provider, origins, destinations=None, start_time=None):
+        """Returns the MatrixResult between origins and destinations (lists of [lon, lat])."""
+        destinations = destinations if destinations is not None else origins
+        bucket = self.bucket(start_time or datetime.now())
+        now = time.time()
+
+        self.compact_ids(now)
+        slot_id = self.slot_id(provider.travel_mode, bucket)
+        keys = self.cell_key(self.ids(origins)[:, None], self.ids(destinations)[None, :], slot_id)
+        result = MatrixResult.empty(len(origins), len(destinations))
+        self.lookup(keys, result, now)
+
+        missing = ~result.valid
+        blocks = missing_blocks(missing)
+        logging.info(f"Route matrix cache: {int(result.valid.sum())} hits, "
+                     f"fetching {sum(len(rows) * len(cols) for rows, cols in blocks)} cells in {len(blocks)} blocks")
+
+        for rows, cols in blocks:
+            fetched = await provider.matrix(
+                [origins[i] for i in rows],
+                [destinations[j] for j in cols],
+                start_time=start_time
+            )
+            block = np.ix_(rows, cols)
+            fill = missing[block] & fetched.valid
+            result.durations[block] = np.where(fill, fetched.durations, result.durations[block])
+            result.distances[block] = np.where(fill, fetched.distances, result.distances[block])
+            result.valid[block] |= fill
+        if blocks:
+            # Another request may have renumbered the points meanwhile
+            keys = self.cell_key(self.ids(origins)[:, None], self.ids(destinations)[None, :], slot_id)
+            await self.store(keys, result, missing, now)
+        return result
+
+    async def route_rows(self, provider, origins, destinations_per_origin, start_time=None):
+        """Returns, for every origin, the 1 x len(destinations) MatrixResult to its own destinations."""
+        bucket = self.bucket(start_time or datetime.now())
+        now = time.time()
+
+        self.compact_ids(now)
+        slot_id = self.slot_id(provider.travel_mode, bucket)
+
+        def row_keys(i):
+            return self.cell_key(self.point_id(self.point_key(origins[i])), self.ids(destinations_per_origin[i]), slot_id)
+
+        results = [MatrixResult.empty(1, len(destinations)) for destinations in destinations_per_origin]
+        for i, row in enumerate(results):
+            self.lookup(row_keys(i)[None, :], row, now)
+
+        missing_rows = [i for i, row in enumerate(results) if not row.all_valid()]
+        missing_cols = [np.flatnonzero(~results[i].valid[0]).tolist() for i in missing_rows]
+        logging.info(f"Route matrix cache: {sum(int(row.valid.sum()) for row in results)} hits, "
+                     f"fetching {sum(len(cols) for cols in missing_cols)} cells")
+        if not missing_rows:
+            return results
+
+        fetched = await provider.rows(
+            [origins[i] for i in missing_rows],
+            [[destinations_per_origin[i][j] for j in cols] for i, cols in zip(missing_rows, missing_cols)],
+            start_time=start_time
+        )
+        stored = []
+        for i, cols, row in zip(missing_rows, missing_cols, fetched):
+            results[i].durations[0, cols] = row.durations[0]
+            results[i].distances[0, cols] = row.distances[0]
+            results[i].valid[0, cols] = row.valid[0]
+            routed = np.asarray(cols, dtype=np.intp)[row.valid[0]]
+            # The keys are computed after the fetch, another request may have renumbered the points meanwhile
+            stored.append((row_keys(i)[routed], results[i].durations[0, routed], results[i].distances[0, routed]))
+        if stored:
+            await self.save(*(np.concatenate(arrays) for arrays in zip(*stored)), now)
+        return results
@@ -14,7 +14,61 @@
 
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
+import os
 import math
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mio.service.clustering import cluster_waypoints, border_pairs, medoid
+from mio.service.exact_solver import exact_routes
+
+# Number of re-solves on the time dependent matrix when several departure time slices are given
+TIME_DEPENDENT_ITERATIONS = 3
+# Longest route distance (Distance dimension capacity) and the cost per unit of the longest route
+MAX_ROUTE_DISTANCE = 2000000
+DISTANCE_SPAN_COST_COEFFICIENT = 100
+# How long a vehicle dwells on a node, in minutes
+SERVICE_TIME_MINUTES = 10
+# Speed used to turn distances into travel times when no time_matrix is given
+VEHICLE_SPEED_KPH = 50
+# Default search budget: TIME_LIMIT_BASE_SECONDS plus TIME_LIMIT_PER_NODE_SECONDS per node and per
+# square root of the number of vehicles, never more than MAX_TIME_LIMIT_SECONDS (also caps the requests)
+TIME_LIMIT_BASE_SECONDS = 0.1
+TIME_LIMIT_PER_NODE_SECONDS = 0.01
+MAX_TIME_LIMIT_SECONDS = 60
+# The search stops once the best solution has not improved for STALL_FRACTION of the time limit
+STALL_FRACTION = 0.1
+MIN_STALL_SECONDS = 0.05
+# Share of the default time limit given to a search which starts from a previous plan
+WARM_START_TIME_FRACTION = 0.25
+# (first solution strategy, metaheuristic) run side by side by the portfolio mode, in this order
+PORTFOLIO = [
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+    ("SAVINGS", "GUIDED_LOCAL_SEARCH"),
+    ("PARALLEL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH"),
+    ("PATH_CHEAPEST_ARC", "TABU_SEARCH"),
+    ("LOCAL_CHEAPEST_INSERTION", "SIMULATED_ANNEALING"),
+    ("CHRISTOFIDES", "GUIDED_LOCAL_SEARCH"),
+    ("PATH_MOST_CONSTRAINED_ARC", "TABU_SEARCH"),
+    ("SAVINGS", "SIMULATED_ANNEALING"),
+]
+# Requests with at least DECOMPOSITION_MIN_WAYPOINTS waypoints are solved as one cluster per vehicle
+DECOMPOSITION_MIN_WAYPOINTS = 1000
+# Repair passes over pairs of neighbouring clusters after a decomposed solve
+REPAIR_ROUNDS = 2
+# Share of the time limit of a decomposed request for routing the clusters, the repair rounds get the rest
+CLUSTER_TIME_FRACTION = 0.5
+# Solver processes (portfolio and decomposition) are started once and reused by the following requests
+solver_pool = None
+solver_pool_workers = 0
+# Processes the portfolio, decomposition and rolling horizon modes may use, see limit_pool_workers()
+pool_workers_limit = os.cpu_count() or 1
 
 def print_solution(data, manager, routing, solution):
     """Prints solution on console."""
@@ -93,7 +147,110 @@ def get_result(data, manager, routing, solution):
     return result
 
 
-def optimizer(data):
+def register_transit(routing, manager, matrix, native=True):
+    """Registers the node indexed integer matrix as a transit evaluator and returns its index.
+
+    native=True hands the matrix to OR-Tools so arc evaluations stay in C++, native=False wraps
+    it in a Python callback (only kept to compare the two, see examples/benchmark_transit.py).
+    """
+    if native:
+        return routing.RegisterTransitMatrix(matrix)
+
+    def transit_callback(from_index, to_index):
+        # Convert from routing variable Index to matrix NodeIndex.
+        return matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
+
+    return routing.RegisterTransitCallback(transit_callback)
+
+
+def get_search_parameters(data):
+    """Returns the search parameters and the stall time (seconds, 0 for none) for data.
+
+    data["search"] optionally sets "time_limit" (seconds), "solution_limit",
+    "first_solution_strategy" and "metaheuristic" (OR-Tools enum names) and "stall_seconds"
+    ("target_objective" is read by solve(), "exact", "portfolio" and "decompose" by optimizer()).
+    """
+    search = data.get("search") or {}
+    num_nodes = len(data["distance_matrix"])
+    time_limit = TIME_LIMIT_BASE_SECONDS + TIME_LIMIT_PER_NODE_SECONDS * num_nodes * math.sqrt(data["num_vehicles"])
+    if data.get("initial_routes"):
+        time_limit *= WARM_START_TIME_FRACTION
+    time_limit = float(search.get("time_limit", time_limit))
+    time_limit = min(max(time_limit, 0.001), MAX_TIME_LIMIT_SECONDS)
+
+    first_solution_strategy = search.get("first_solution_strategy", "PATH_CHEAPEST_ARC")
+    metaheuristic = search.get("metaheuristic", "GUIDED_LOCAL_SEARCH")
+    if first_solution_strategy not in routing_enums_pb2.FirstSolutionStrategy.Value.keys():
+        raise ValueError(f"Error: Unknown first_solution_strategy {first_solution_strategy}")
+    if metaheuristic not in routing_enums_pb2.LocalSearchMetaheuristic.Value.keys():
+        raise ValueError(f"Error: Unknown metaheuristic {metaheuristic}")
+
+    parameters = pywrapcp.DefaultRoutingSearchParameters()
+    parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+    parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+    parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+    if search.get("solution_limit"):
+        parameters.solution_limit = int(search["solution_limit"])
+    stall_seconds = float(search.get("stall_seconds", max(MIN_STALL_SECONDS, STALL_FRACTION * time_limit)))
+    return parameters, stall_seconds
+
+
+def add_stall_limit(routing, stall_seconds):
+    """Stops the search once the objective has not improved for stall_seconds.
+
+    Checked on every solution the local search accepts, a Python search limit would instead be
+    called from C++ on every move it evaluates.
+    """
+    state = {"best": None, "improved_at": None}
+    solver = routing.solver()
+
+    def on_solution():
+        objective = routing.CostVar().Value()
+        now = time.monotonic()
+        if state["best"] is None or objective < state["best"]:
+            state["best"] = objective
+            state["improved_at"] = now
+        elif now - state["improved_at"] > stall_seconds:
+            solver.FinishCurrentSearch()
+
+    routing.AddAtSolutionCallback(on_solution)
+
+
+def add_solution_callback(routing, manager, data, on_solution=None, target_objective=None):
+    """Calls on_solution(result, objective) for every improving solution, result being the nodes
+    of every vehicle as returned by optimizer(). The search stops once the objective is at most
+    target_objective or once on_solution returns True."""
+    state = {"best": None}
+    solver = routing.solver()
+
+    def at_solution():
+        objective = routing.CostVar().Value()
+        if state["best"] is not None and objective >= state["best"]:
+            return
+        state["best"] = objective
+        if target_objective is not None and objective <= target_objective:
+            solver.FinishCurrentSearch()
+        if on_solution:
+            result = {}
+            for vehicle_id in range(data["num_vehicles"]):
+                index = routing.Start(vehicle_id)
+                result[vehicle_id] = [manager.IndexToNode(index)]
+                while not routing.IsEnd(index):
+                    index = routing.NextVar(index).Value()
+                    result[vehicle_id].append(manager.IndexToNode(index))
+            if on_solution(result, objective):
+                solver.FinishCurrentSearch()
+
+    routing.AddAtSolutionCallback(at_solution)
+
+
+def solve(data, initial_routes=None, native_transits=True, on_solution=None):
+    """Builds the routing model for data and solves it, starting from initial_routes when given.
+
+    initial_routes holds, for every vehicle, the nodes visited between its start and its end.
+    on_solution and data["search"]["target_objective"] are described in add_solution_callback().
+    Returns (manager, routing, solution), solution is None when no solution was found.
+    """
     manager = pywrapcp.RoutingIndexManager(
         len(data["distance_matrix"]),
         data["num_vehicles"],
@@ -101,39 +258,35 @@ def optimizer(data):
         data["ends"]
     )
     routing = pywrapcp.RoutingModel(manager)
-    def distance_callback(from_index, to_index):
-        """Returns the distance between the two nodes."""
-        # Convert from routing variable Index to distance matrix NodeIndex.
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return data["distance_matrix"][from_node][to_node]
-
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    # data["distance_matrix"] holds meters and data["time_matrix"] seconds, both integers. Without a
+    # time_matrix (older callers) distance_matrix is the only metric and travel times are derived from it
+    time_matrix = data.get("time_matrix")
+    transit_callback_index = register_transit(routing, manager, data["distance_matrix"], native_transits)
+    # The routes are optimized for travel time
+    if time_matrix is not None:
+        routing.SetArcCostEvaluatorOfAllVehicles(register_transit(routing, manager, time_matrix, native_transits))
+    else:
+        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
     dimension_name = "Distance"
     routing.AddDimension(
         transit_callback_index,
         0,  # no slack
-        2000000,  # vehicle maximum travel distance
+        MAX_ROUTE_DISTANCE,  # vehicle maximum travel distance
         True,  # start cumul to zero
         dimension_name,
     )
     distance_dimension = routing.GetDimensionOrDie(dimension_name)
-    distance_dimension.SetGlobalSpanCostCoefficient(100)
+    distance_dimension.SetGlobalSpanCostCoefficient(DISTANCE_SPAN_COST_COEFFICIENT)
 
     # [START time constraint]
-    def time_callback(from_index, to_index):
-        service_time_mins = 10 # how long vehicle dwells on the node
-        vehicle_speed_kph = 50 # speed of each vehicle
-
-        distance_km = distance_callback(from_index, to_index) * data["distanceUnitToKm"]
-        travel_time_mins = (distance_km / vehicle_speed_kph) * 60
-        total_time_mins = math.ceil(travel_time_mins + service_time_mins)
-
-        return total_time_mins
-
     if 'vehicle_shifts' in data:
-        time_callback_index = routing.RegisterTransitCallback(time_callback)
+        # Travel plus service time in minutes of every arc, computed once instead of on every evaluation
+        if time_matrix is not None:
+            time_minutes = [[math.ceil(seconds / 60 + SERVICE_TIME_MINUTES) for seconds in row] for row in time_matrix]
+        else:
+            time_minutes = [[math.ceil(distance * data["distanceUnitToKm"] / VEHICLE_SPEED_KPH * 60 + SERVICE_TIME_MINUTES)
+                             for distance in row] for row in data["distance_matrix"]]
+        time_callback_index = register_transit(routing, manager, time_minutes, native_transits)
 
         routing.AddDimension(
             time_callback_index,
@@ -162,15 +315,500 @@ def optimizer(data):
                 time_dimension.CumulVar(routing.End(i)))
     # [END time constraint]
 
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-    )
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.FromSeconds(1)
+    search_parameters, stall_seconds = get_search_parameters(data)
+    if stall_seconds > 0:
+        add_stall_limit(routing, stall_seconds)
+    target_objective = (data.get("search") or {}).get("target_objective")
+    if on_solution or target_objective is not None:
+        add_solution_callback(routing, manager, data, on_solution, target_objective)
+
+    if initial_routes:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_assignment = routing.ReadAssignmentFromRoutes(
+            [[manager.NodeToIndex(node) for node in route] for route in initial_routes], True)
+        if initial_assignment:
+            solution = routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
+        else:
+            solution = routing.SolveWithParameters(search_parameters)
+    else:
+        solution = routing.SolveWithParameters(search_parameters)
+    return manager, routing, solution
+
+
+def get_routes(data, manager, routing, solution):
+    """Returns, for every vehicle, the nodes visited between its start and its end."""
+    routes = []
+    for vehicle_id in range(data["num_vehicles"]):
+        index = solution.Value(routing.NextVar(routing.Start(vehicle_id)))
+        route = []
+        while not routing.IsEnd(index):
+            route.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        routes.append(route)
+    return routes
+
+
+def complete_routes(data, routes):
+    """Returns routes (waypoints of every vehicle, e.g. from a previous plan) made valid for data.
+
+    Unknown and repeated nodes are dropped and every waypoint missing from the routes is added
+    where it increases the travel cost the least (cheapest insertion).
+    """
+    cost = data.get("time_matrix") or data["distance_matrix"]
+    fixed = set(data["starts"]) | set(data["ends"])
+    waypoints = [node for node in range(len(cost)) if node not in fixed]
+    routes = [list(route) for route in routes[:data["num_vehicles"]]]
+    routes += [[] for _ in range(data["num_vehicles"] - len(routes))]
+
+    seen = set()
+    for vehicle_id, route in enumerate(routes):
+        routes[vehicle_id] = [node for node in route if node in waypoints and not (node in seen or seen.add(node))]
+
+    for node in waypoints:
+        if node in seen:
+            continue
+        best = None
+        for vehicle_id, route in enumerate(routes):
+            nodes = [data["starts"][vehicle_id]] + route + [data["ends"][vehicle_id]]
+            for position in range(1, len(nodes)):
+                before, after = nodes[position - 1], nodes[position]
+                delta = cost[before][node] + cost[node][after] - cost[before][after]
+                if best is None or delta < best[0]:
+                    best = (delta, vehicle_id, position - 1)
+        routes[best[1]].insert(best[2], node)
+        seen.add(node)
+    return routes
+
+
+def time_dependent_matrix(data, routes):
+    """Builds the matrix where every row comes from the slice of data["time_matrices"] in which
+    the vehicle leaves that node, following the given routes from a departure at time 0.
+
+    Rows of nodes not on any route (and of the ends) come from the first slice. Also returns the
+    total time dependent travel time of the routes.
+    """
+    slices = data["time_matrices"]
+    slice_seconds = data["slice_seconds"]
+    matrix = [list(row) for row in slices[0]]
+    total = 0
+    for vehicle_id, route in enumerate(routes):
+        nodes = [data["starts"][vehicle_id]] + route + [data["ends"][vehicle_id]]
+        elapsed = 0
+        for from_node, to_node in zip(nodes, nodes[1:]):
+            slice_index = min(int(elapsed // slice_seconds), len(slices) - 1)
+            matrix[from_node] = slices[slice_index][from_node]
+            elapsed += slices[slice_index][from_node][to_node]
+        total += elapsed
+    return matrix, total
+
+
+def routes_objective(data, routes):
+    """Objective of the OR-Tools model for routes (the waypoints of every vehicle): the arc costs
+    (travel times, or distances without a time_matrix) plus the span cost of the longest route distance."""
+    cost = data.get("time_matrix") or data["distance_matrix"]
+    total = 0
+    longest = 0
+    for vehicle_id, route in enumerate(routes):
+        if not route:
+            continue
+        nodes = [data["starts"][vehicle_id]] + route + [data["ends"][vehicle_id]]
+        total += sum(cost[a][b] for a, b in zip(nodes, nodes[1:]))
+        longest = max(longest, sum(data["distance_matrix"][a][b] for a, b in zip(nodes, nodes[1:])))
+    return total + DISTANCE_SPAN_COST_COEFFICIENT * longest
+
+
+def routes_result(data, routes):
+    """Result of optimizer() for routes, the nodes of every vehicle from its start to its end."""
+    return {
+        vehicle_id: [data["starts"][vehicle_id]] + route + [data["ends"][vehicle_id]]
+        for vehicle_id, route in enumerate(routes)
+    }
+
+
+def limit_pool_workers(workers):
+    """Caps the solver pool of this process at workers processes.
+
+    Called in every process of the solver executor, so that the solves running side by side share
+    the cores instead of each starting a pool as large as the host.
+    """
+    global pool_workers_limit
+    pool_workers_limit = max(1, workers)
+
+
+def get_pool(workers):
+    """Returns the solver process pool, started (or restarted larger) to run workers processes."""
+    global solver_pool, solver_pool_workers
+    if solver_pool is None or solver_pool_workers < workers:
+        if solver_pool is not None:
+            solver_pool.shutdown(wait=False)
+        # spawn, a forked copy of the Function host (event loop, sockets, threads) is not safe to use
+        solver_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        solver_pool_workers = workers
+    return solver_pool
+
+
+def pool_results(futures):
+    """Waits for the futures of the solver pool, the result of a failed one is None."""
+    global solver_pool
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as ex:
+            # A crashed worker breaks the pool, the next request starts a new one
+            logging.warning(f"Solver worker failed: {ex}")
+            if isinstance(ex, BrokenProcessPool):
+                solver_pool = None
+            results.append(None)
+    return results
+
+
+def portfolio_worker(data, matrices, first_solution_strategy, metaheuristic):
+    """Solves data with one strategy in a pool process and returns (objective, result, strategy).
+
+    matrices maps the matrix keys of data to (shared memory name, shape) of read-only int64 arrays.
+    """
+    blocks = []
+    try:
+        for key, (name, shape) in matrices.items():
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            data[key] = np.ndarray(shape, dtype=np.int64, buffer=block.buf).tolist()
+        search = dict(data.get("search") or {}, first_solution_strategy=first_solution_strategy, metaheuristic=metaheuristic)
+        manager, routing, solution = solve(dict(data, search=search), initial_routes=data.get("initial_routes"))
+        if not solution:
+            return None
+        return solution.ObjectiveValue(), get_result(data, manager, routing, solution), f"{first_solution_strategy}/{metaheuristic}"
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def solve_portfolio(data, workers):
+    """Runs the first workers strategies of PORTFOLIO in parallel processes, each on its own
+    RoutingModel with the same time limit, and returns the result with the best objective."""
+    pool = get_pool(workers)
+    # The matrices are copied once into shared memory instead of being pickled for every worker
+    keys = [key for key in ("time_matrix", "distance_matrix") if data.get(key) is not None]
+    blocks = []
+    try:
+        matrices = {}
+        for key in keys:
+            array = np.asarray(data[key], dtype=np.int64)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=np.int64, buffer=block.buf)[...] = array
+            matrices[key] = (block.name, array.shape)
+        task_data = {key: value for key, value in data.items() if key not in keys}
+        futures = [pool.submit(portfolio_worker, task_data, matrices, first_solution_strategy, metaheuristic)
+                   for first_solution_strategy, metaheuristic in PORTFOLIO[:workers]]
+        results = [result for result in pool_results(futures) if result]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if not results:
+        return {}
+    objective, result, strategy = min(results, key=lambda result: result[0])
+    logging.info(f"Objective: {objective} ({strategy}, best of {len(results)})")
+    return result
+
+
+def subproblem(data, matrices, vehicles, waypoints, initial_routes=None, starts=None, open_end=False, vehicle_shifts=None,
+               search=None):
+    """Data of the sub-problem of the given vehicles and waypoints, with the nodes renumbered.
+
+    matrices holds data["time_matrix"] and data["distance_matrix"] as numpy arrays. starts
+    replaces the start nodes of the vehicles, open_end=True ends the routes at their last stop
+    and vehicle_shifts gives the shifts of the vehicles. The search strategies and stall_seconds
+    of data carry over, search adds to them (e.g. a time_limit, by default the one of the sub-problem size).
+    Returns (sub-problem data, the node of data of every node of the sub-problem).
+    """
+    starts = starts or [data["starts"][v] for v in vehicles]
+    ends = [] if open_end else [data["ends"][v] for v in vehicles]
+    nodes = list(dict.fromkeys(starts + ends + waypoints))
+    local = {node: i for i, node in enumerate(nodes)}
+    sub_matrices = {key: matrix[np.ix_(nodes, nodes)] for key, matrix in matrices.items()}
+    if open_end:
+        # The routes end at an extra node which is free to reach from every other one
+        sub_matrices = {key: np.pad(matrix, ((0, 1), (0, 1))) for key, matrix in sub_matrices.items()}
+    sub = {key: matrix.tolist() for key, matrix in sub_matrices.items()}
+    sub["num_vehicles"] = len(vehicles)
+    sub["starts"] = [local[node] for node in starts]
+    sub["ends"] = [len(nodes)] * len(vehicles) if open_end else [local[node] for node in ends]
+    if vehicle_shifts:
+        sub["vehicle_shifts"] = vehicle_shifts
+    if "distanceUnitToKm" in data:
+        sub["distanceUnitToKm"] = data["distanceUnitToKm"]
+    search = dict({key: value for key, value in (data.get("search") or {}).items()
+                   if key in ("first_solution_strategy", "metaheuristic", "exact", "stall_seconds")}, **(search or {}))
+    if search:
+        sub["search"] = search
+    if initial_routes:
+        sub["initial_routes"] = [[local[node] for node in route] for route in initial_routes]
+    return sub, nodes
+
+
+def subproblem_worker(data):
+    """Solves a sub-problem, in a pool process or inline, and returns the waypoints of every vehicle or None."""
+    if (data.get("search") or {}).get("exact", True) and not data.get("initial_routes") and "vehicle_shifts" not in data:
+        exact = exact_routes(data, DISTANCE_SPAN_COST_COEFFICIENT, MAX_ROUTE_DISTANCE)
+        if exact:
+            return exact[1]
+    manager, routing, solution = solve(data, initial_routes=data.get("initial_routes"))
+    return get_routes(data, manager, routing, solution) if solution else None
+
+
+def batch_time_limit(seconds, num_tasks, workers):
+    """Time limit of every one of num_tasks solves for all of them to finish within seconds on workers processes."""
+    return seconds / max(1, math.ceil(num_tasks / max(1, min(workers, num_tasks))))
+
+
+def solve_subproblems(tasks, workers):
+    """Solves the sub-problems on up to workers processes, in the Function process with one worker."""
+    if workers <= 1 or len(tasks) <= 1:
+        return [subproblem_worker(task) for task in tasks]
+    pool = get_pool(workers)
+    return pool_results([pool.submit(subproblem_worker, task) for task in tasks])
+
+
+def solve_decomposed(data, workers, on_solution=None):
+    """Cluster first, route second: returns the waypoints of every vehicle, or None when a cluster has no solution.
+
+    The waypoints are split into one cluster per vehicle (capacitated k-medoids around the vehicle
+    starts, or the routes of a previous plan), every cluster is routed on its own small model in
+    parallel, then REPAIR_ROUNDS passes re-solve pairs of neighbouring clusters together, starting
+    from their current routes, which moves the waypoints on the cluster borders to the better vehicle.
+    on_solution(result, objective) gets the plan after the clusters and after every improving repair
+    round, returning True skips the remaining rounds.
+    A time_limit of data["search"] is shared: CLUSTER_TIME_FRACTION for the clusters, the rest for the
+    repair rounds, which are skipped once it is spent or the plan reaches the target_objective.
+    """
+    search = data.get("search") or {}
+    deadline = time.monotonic() + float(search["time_limit"]) if "time_limit" in search else None
+    target_objective = search.get("target_objective")
+    matrices = {key: np.asarray(data[key], dtype=np.int64) for key in ("time_matrix", "distance_matrix") if data.get(key) is not None}
+    distance_matrix = matrices["distance_matrix"]
+    num_vehicles = data["num_vehicles"]
+    if data.get("initial_routes"):
+        clusters = data["initial_routes"]
+    else:
+        fixed = set(data["starts"]) | set(data["ends"])
+        clusters, _ = cluster_waypoints(distance_matrix, data["starts"], [node for node in range(len(distance_matrix)) if node not in fixed])
+
+    cluster_search = None
+    if deadline:
+        cluster_search = {"time_limit": batch_time_limit(CLUSTER_TIME_FRACTION * float(search["time_limit"]), num_vehicles, workers)}
+    tasks = [subproblem(data, matrices, [vehicle_id], clusters[vehicle_id], search=cluster_search) for vehicle_id in range(num_vehicles)]
+    results = solve_subproblems([sub for sub, _ in tasks], workers)
+    if any(result is None for result in results):
+        return None
+    routes = [[nodes[node] for node in result[0]] for result, (_, nodes) in zip(results, tasks)]
+    objective = routes_objective(data, routes)
+    logging.info(f"Decomposed into {num_vehicles} clusters, objective {objective}")
+    if on_solution and on_solution(routes_result(data, routes), objective):
+        return routes
+
+    for rank in range(REPAIR_ROUNDS):
+        if target_objective is not None and objective <= target_objective:
+            break
+        medoids = [medoid(distance_matrix, route) if route else data["starts"][vehicle_id] for vehicle_id, route in enumerate(routes)]
+        pairs = border_pairs(distance_matrix, medoids, rank)
+        repair_search = None
+        if deadline:
+            # The rounds left share what is left of the time limit, a round finishing early leaves more to the next
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.info(f"Time limit reached, {REPAIR_ROUNDS - rank} repair rounds skipped")
+                break
+            repair_search = {"time_limit": batch_time_limit(remaining / (REPAIR_ROUNDS - rank), len(pairs), workers)}
+        tasks = [subproblem(data, matrices, [a, b], routes[a] + routes[b], [routes[a], routes[b]], search=repair_search)
+                 for a, b in pairs]
+        results = solve_subproblems([sub for sub, _ in tasks], workers)
+        improved = False
+        for (a, b), result, (_, nodes) in zip(pairs, results, tasks):
+            if result is None:
+                continue
+            candidate = list(routes)
+            candidate[a], candidate[b] = ([nodes[node] for node in route] for route in result)
+            candidate_objective = routes_objective(data, candidate)
+            if candidate_objective < objective:
+                routes, objective, improved = candidate, candidate_objective, True
+        logging.info(f"Repair round {rank + 1}: {len(pairs)} cluster pairs, objective {objective}")
+        if improved and on_solution and on_solution(routes_result(data, routes), objective):
+            break
+    return routes
+
+
+def arc_minutes(data, from_node, to_node):
+    """Travel plus service time of an arc in minutes, as in the Time dimension of solve()."""
+    if data.get("time_matrix") is not None:
+        return math.ceil(data["time_matrix"][from_node][to_node] / 60 + SERVICE_TIME_MINUTES)
+    return math.ceil(data["distance_matrix"][from_node][to_node] * data["distanceUnitToKm"] / VEHICLE_SPEED_KPH * 60 + SERVICE_TIME_MINUTES)
+
+
+def solve_rolling_horizon(data, workers):
+    """Solves the planning windows of data["windows"] (lists of waypoints, e.g. one per shift or
+    service day) one model at a time, so the model size and memory follow the largest window.
+
+    Without data["carry_over"] every window starts at the vehicle starts and ends at the vehicle
+    ends, the windows are independent and solved in parallel. With it the vehicles leave every
+    window from where (and, with shifts, when) they finished the previous one, only the last window
+    goes to the ends, and the waypoints a window could not serve move to the next one.
+    data["window_shifts"] optionally gives the vehicle shifts of every window (default vehicle_shifts).
+    A time_limit of data["search"] is split over the windows, its stall_seconds and target_objective
+    apply to every window.
+    Returns (the nodes of every vehicle from its start to its end, the waypoints never served).
+    """
+    matrices = {key: np.asarray(data[key], dtype=np.int64) for key in ("time_matrix", "distance_matrix") if data.get(key) is not None}
+    num_vehicles = data["num_vehicles"]
+    vehicles = list(range(num_vehicles))
+    fixed = set(data["starts"]) | set(data["ends"])
+    windows = [[node for node in window if node not in fixed] for window in data["windows"]]
+    # Waypoints missing from the windows are planned in the first one
+    planned = {node for window in windows for node in window}
+    windows[0] = [node for node in range(len(data["distance_matrix"])) if node not in fixed and node not in planned] + windows[0]
+    window_shifts = data.get("window_shifts") or [data.get("vehicle_shifts")] * len(windows)
+    search = data.get("search") or {}
+    window_search = {"target_objective": search["target_objective"]} if "target_objective" in search else {}
+    deadline = time.monotonic() + float(search["time_limit"]) if "time_limit" in search else None
+
+    if not data.get("carry_over"):
+        if deadline:
+            window_search["time_limit"] = batch_time_limit(float(search["time_limit"]), len(windows), workers)
+        tasks = [subproblem(data, matrices, vehicles, window, vehicle_shifts=shifts, search=window_search)
+                 for window, shifts in zip(windows, window_shifts)]
+        results = solve_subproblems([sub for sub, _ in tasks], workers)
+        sequences = [[] for _ in vehicles]
+        served = set()
+        for result, (_, nodes) in zip(results, tasks):
+            for vehicle_id, route in enumerate(result or []):
+                if route:
+                    sequences[vehicle_id] += [data["starts"][vehicle_id]] + [nodes[node] for node in route] + [data["ends"][vehicle_id]]
+                    served.update(nodes[node] for node in route)
+        sequences = [sequence or [data["starts"][v], data["ends"][v]] for v, sequence in enumerate(sequences)]
+        return sequences, [node for window in windows for node in window if node not in served]
+
+    positions = list(data["starts"])
+    ready = [None] * num_vehicles
+    routes = [[] for _ in vehicles]
+    carried = []
+    for index, window in enumerate(windows):
+        waypoints = carried + window
+        last = index == len(windows) - 1
+        if not waypoints and not last:
+            continue
+        shifts = None
+        if window_shifts[index]:
+            # A vehicle is not available before it finished the previous window
+            shifts = [[min(max(start, ready[v] if ready[v] is not None else start), end), end]
+                      for v, (start, end) in enumerate(window_shifts[index])]
+        if deadline:
+            # The windows left share what is left of the time limit, a window finishing early leaves more to the next
+            window_search["time_limit"] = max(deadline - time.monotonic(), 0) / (len(windows) - index)
+        sub, nodes = subproblem(data, matrices, vehicles, waypoints, starts=positions, open_end=not last, vehicle_shifts=shifts,
+                                search=window_search)
+        result = solve_subproblems([sub], 1)[0] or [[] for _ in vehicles]
+        window_routes = [[nodes[node] for node in route] for route in result]
+        for v, route in enumerate(window_routes):
+            if shifts:
+                path = [positions[v]] + route
+                ready[v] = shifts[v][0] + sum(arc_minutes(data, a, b) for a, b in zip(path, path[1:]))
+            if route:
+                routes[v] += route
+                positions[v] = route[-1]
+        served = {node for route in window_routes for node in route}
+        carried = [node for node in waypoints if node not in served]
+        logging.info(f"Window {index + 1}/{len(windows)}: {len(served)} waypoints served, {len(carried)} carried over")
+    return [[data["starts"][v]] + routes[v] + [data["ends"][v]] for v in vehicles], carried
+
+
+def optimizer(data, on_solution=None):
+    """Returns the nodes of every vehicle from its start to its end (plus "droppedNodes" and "time"
+    with shifts), or {} when there is no solution.
+
+    on_solution(result, objective) is called with every improving plan while the search runs, the
+    portfolio and rolling horizon modes only report their final plan. Returning True stops the search.
+    """
+    # "windows" plans a horizon of shifts or service days one window at a time (see solve_rolling_horizon)
+    if len(data.get("windows") or []) > 1 and len(data.get("time_matrices", [])) <= 1:
+        sequences, dropped = solve_rolling_horizon(data, min(len(data["windows"]), pool_workers_limit))
+        logging.info(f"Rolling horizon: {len(data['windows'])} windows, {len(dropped)} waypoints not served")
+        result = dict(enumerate(sequences))
+        if on_solution:
+            on_solution(dict(result), None)
+        if dropped or "vehicle_shifts" in data or data.get("window_shifts"):
+            result["droppedNodes"] = dropped
+        return result
+
+    # Tiny instances (a few waypoints, one to three vehicles) are solved to optimality by dynamic
+    # programming in milliseconds, shifts and time dependent slices always go through OR-Tools
+    search = data.get("search") or {}
+    if "vehicle_shifts" not in data and len(data.get("time_matrices", [])) <= 1 and search.get("exact", True):
+        exact = exact_routes(data, DISTANCE_SPAN_COST_COEFFICIENT, MAX_ROUTE_DISTANCE)
+        if exact:
+            objective, routes = exact
+            logging.info(f"Objective: {objective} (exact)")
+            if on_solution:
+                on_solution(routes_result(data, routes), objective)
+            return routes_result(data, routes)
+
+    # A previous plan (data["initial_routes"], waypoints of every vehicle) is completed with the new
+    # waypoints and used as the first solution, so small edits only need a short local search
+    if data.get("initial_routes"):
+        data = dict(data, initial_routes=complete_routes(data, data["initial_routes"]))
+
+    # "decompose": true splits the problem into one cluster per vehicle solved on up to one core each,
+    # the default for DECOMPOSITION_MIN_WAYPOINTS waypoints and more. Shifts and time slices need the full model
+    num_waypoints = len(data["distance_matrix"]) - len(set(data["starts"]) | set(data["ends"]))
+    decompose = search.get("decompose", num_waypoints >= DECOMPOSITION_MIN_WAYPOINTS)
+    if decompose and data["num_vehicles"] > 1 and "vehicle_shifts" not in data and len(data.get("time_matrices", [])) <= 1:
+        routes = solve_decomposed(data, min(data["num_vehicles"], pool_workers_limit), on_solution)
+        if routes:
+            logging.info(f"Objective: {routes_objective(data, routes)} (decomposed)")
+            return routes_result(data, routes)
+        logging.warning("Decomposition found no solution for a cluster, solving the full problem")
+
+    # "portfolio": N runs N strategy combinations on up to N cores and keeps the best one
+    workers = min(int(search.get("portfolio") or 0), len(PORTFOLIO), pool_workers_limit)
+    if workers == 1 and int(search.get("portfolio") or 0) > 1:
+        logging.warning(f"Portfolio of {search['portfolio']} capped to 1 process (the share of the cores of this solver process), "
+                        "solving with a single strategy. Lower MIO_SOLVER_WORKERS to run portfolios")
+    if workers > 1 and len(data.get("time_matrices", [])) <= 1:
+        result = solve_portfolio(data, workers)
+        if on_solution and result:
+            on_solution({key: value for key, value in result.items() if isinstance(key, int)}, None)
+        return result
+
+    # The solves of time dependent travel times (see below) share one time limit: the first solve gets
+    # one share and every re-solve, warm started from the previous routes, WARM_START_TIME_FRACTION of one
+    time_dependent = len(data.get("time_matrices", [])) > 1
+    if time_dependent:
+        time_limit = get_search_parameters(data)[0].time_limit.ToMilliseconds() / 1000
+        share = time_limit / (1 + TIME_DEPENDENT_ITERATIONS * WARM_START_TIME_FRACTION)
+        data = dict(data, search=dict(search, time_limit=share))
+
+    manager, routing, solution = solve(data, initial_routes=data.get("initial_routes"), on_solution=on_solution)
 
-    solution = routing.SolveWithParameters(search_parameters)
+    # OR-Tools transit callbacks cannot see the arrival time, so time dependent travel times are
+    # approximated by re-solving on the rows of the slices the previous solution leaves each node in,
+    # until the slices do not change any more. The solution with the lowest time dependent travel time is kept
+    if solution and time_dependent:
+        best = None
+        for iteration in range(TIME_DEPENDENT_ITERATIONS + 1):
+            routes = get_routes(data, manager, routing, solution)
+            matrix, total = time_dependent_matrix(data, routes)
+            if best is None or total < best[0]:
+                best = (total, data, manager, routing, solution)
+            if matrix == data["time_matrix"] or iteration == TIME_DEPENDENT_ITERATIONS:
+                break
+            data = dict(data, time_matrix=matrix, initial_routes=routes,
+                        search=dict(search, time_limit=share * WARM_START_TIME_FRACTION))
+            manager, routing, solution = solve(data, initial_routes=data["initial_routes"])
+            if not solution:
+                break
+        total, data, manager, routing, solution = best
 
     if solution:
         print_solution(data, manager, routing, solution)
@@ -0,0 +1,51 @@
+import logging
+
+import numpy as np
+
+from mio.service.matrix_provider import MatrixResult
+from mio.utils.geo import great_circle_matrix
+
+def nearest_neighbors(distances, k):
+    """Indexes of the k closest destinations of every origin, skipping destinations at the same place."""
+    distances = np.where(distances > 0, distances, np.inf)
+    k = min(k, distances.shape[1])
+    neighbors = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return [[j for j in row if np.isfinite(distances[i, j])] for i, row in enumerate(neighbors.tolist())]
+
+async def sparse_route_matrix(provider, cache, origins, destinations, k, start_time=None):
+    """Returns a MatrixResult where only the arcs to the k nearest neighbours come from the provider.
+
+    The other arcs are great-circle distances scaled by the seconds (and road meters) per meter
+    observed on the fetched arcs (median), so the provider cost grows as N*k instead of N*N.
+    """
+    distances = great_circle_matrix(origins, destinations)
+    neighbors = nearest_neighbors(distances, k)
+    rows = await cache.route_rows(provider, origins, [[destinations[j] for j in row] for row in neighbors], start_time=start_time)
+
+    fetched_rows = np.array([i for i, row in enumerate(neighbors) for j in row], dtype=np.intp)
+    fetched_cols = np.array([j for row in neighbors for j in row], dtype=np.intp)
+    fetched = MatrixResult(
+        np.concatenate([row.durations[0] for row in rows]) if rows else np.zeros(0, dtype=np.int32),
+        np.concatenate([row.distances[0] for row in rows]) if rows else np.zeros(0, dtype=np.float32),
+        np.concatenate([row.valid[0] for row in rows]) if rows else np.zeros(0, dtype=bool)
+    )
+
+    great_circle = distances[fetched_rows, fetched_cols]
+    usable = fetched.valid & (great_circle > 0)
+    if usable.any():
+        seconds_per_meter = float(np.median(fetched.durations[usable] / great_circle[usable]))
+        detour = float(np.median(fetched.distances[usable] / great_circle[usable]))
+    else:
+        seconds_per_meter, detour = 3.6 / 40, 1.3
+    logging.info(f"Sparse route matrix: {len(fetched_rows)} fetched arcs, {seconds_per_meter * 1000:.1f} s/km for the others")
+
+    result = MatrixResult(
+        np.rint(distances * seconds_per_meter).astype(np.int32),
+        (distances * detour).astype(np.float32),
+        np.ones(distances.shape, dtype=bool)
+    )
+    # Fetched arcs the provider could not route stay invalid
+    result.durations[fetched_rows, fetched_cols] = fetched.durations
+    result.distances[fetched_rows, fetched_cols] = fetched.distances
+    result.valid[fetched_rows, fetched_cols] = fetched.valid
+    return result
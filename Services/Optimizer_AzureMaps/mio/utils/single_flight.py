@@ -0,0 +1,23 @@
+import asyncio
+import logging
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing the same key into one outstanding call.
+
+    The first caller for a key starts the call, callers arriving while it is in flight await
+    the same result (or exception). The key is forgotten as soon as the call completes, so
+    this is not a cache: later callers start a new call.
+    """
+    def __init__(self) -> None:
+        self.calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.calls.pop(key, None) if self.calls.get(key) is f else None)
+        else:
+            logging.info(f"Joining in-flight call {key}")
+        # shield so that a cancelled caller does not cancel the call the other callers are waiting for
+        return await asyncio.shield(future)
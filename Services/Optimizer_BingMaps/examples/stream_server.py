@@ -0,0 +1,48 @@
+"""Serves api/mio/stream with a chunked NDJSON response, so every improving plan reaches the client
+as soon as it is found (the Functions host only sends a response body once it is complete).
+
+Closing the connection stops the search. Run from the app folder, with the app settings in the
+environment:
+
+    python -m examples.stream_server --port 7072
+    curl -N -X POST --data @examples/data/2_vehicles_3_waypoints.json http://localhost:7072/api/mio/stream
+"""
+import argparse
+
+from aiohttp import web
+
+from mio import mio_stream, test_data_path
+from mio.utils.http_session import close_session
+
+
+async def stream(request):
+    data = await request.text() or test_data_path.read_text()
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    lines = mio_stream(data)
+    try:
+        async for line in lines:
+            await response.write(line.encode("utf-8"))
+    finally:
+        # Also reached when the client went away, which stops the search
+        await lines.aclose()
+    await response.write_eof()
+    return response
+
+
+async def close_http_session(app):
+    await close_session()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=7072)
+    args = parser.parse_args()
+    app = web.Application()
+    app.router.add_post("/api/mio/stream", stream)
+    app.on_cleanup.append(close_http_session)
+    web.run_app(app, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
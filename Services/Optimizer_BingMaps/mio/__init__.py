@@ -1,4 +1,7 @@
 import os
+import time
+import asyncio
+import threading
 import logging
 import json
 import http.client
@@ -7,16 +10,77 @@ from urllib.parse import unquote
 
 import azure.functions as func
 import aiofiles
+import numpy as np
 
-from mio.service.bing_maps_api import BingMapsApi
-from mio.service.optimizer import optimizer
+from mio.service.bing_maps_api import BingMapsApi, BingMapsProvider
+from mio.service.matrix_provider import EstimateProvider
+from mio.service.optimizer import optimizer, limit_pool_workers
 from mio.utils.log import init_log
+from mio.utils.solution_cache import SolutionCache
+from mio.utils.solver_executor import SolverExecutor, SolverBusyError
 
-test_data = Path("examples/data/2_vehicles_3_waypoints.json").read_text()
+# The solver processes import this package too, so nothing is read or opened here before a request needs it
+test_data_path = Path("examples/data/2_vehicles_3_waypoints.json")
 
+# Defaults of the great-circle estimate used by "matrix_mode": "estimate"
+estimate_speed_kph = float(os.getenv("MIO_ESTIMATE_SPEED_KPH", "40"))
+estimate_detour_factor = float(os.getenv("MIO_ESTIMATE_DETOUR_FACTOR", "1.3"))
+# Number of solver strategies run in parallel processes by default, 0 or 1 solves in process
+solver_portfolio = int(os.getenv("MIO_SOLVER_PORTFOLIO", "0"))
+# Solves run off the event loop on MIO_SOLVER_WORKERS processes (MIO_SOLVER_EXECUTOR=process) or threads
+# (thread), with at most MIO_SOLVER_MAX_QUEUE more waiting. Requests beyond that are answered with 503
+solver_workers = int(os.getenv("MIO_SOLVER_WORKERS", str(os.cpu_count() or 1)))
+solver_executor = SolverExecutor(
+    kind=os.getenv("MIO_SOLVER_EXECUTOR", "process"),
+    workers=solver_workers,
+    max_queue=int(os.getenv("MIO_SOLVER_MAX_QUEUE", "4")),
+    # Each solver process gets its share of the cores for its portfolio or decomposition processes
+    initializer=limit_pool_workers,
+    initargs=((os.cpu_count() or 1) // max(1, solver_workers),)
+)
+# api/mio/stream sends the first improving plan, then at most one every MIO_STREAM_INTERVAL_SECONDS
+stream_interval_seconds = float(os.getenv("MIO_STREAM_INTERVAL_SECONDS", "0.1"))
+# Responses of the last MIO_SOLUTION_CACHE_SIZE distinct problems are kept MIO_SOLUTION_CACHE_TTL_SECONDS
+solution_cache = SolutionCache(
+    max_entries=int(os.getenv("MIO_SOLUTION_CACHE_SIZE", "256")),
+    ttl_seconds=int(os.getenv("MIO_SOLUTION_CACHE_TTL_SECONDS", "300"))
+)
 
 
-async def mio(data: str) -> (int, str):
+
+def bing_maps_provider():
+    # BME_KEY is the environment variable name for the Bing Maps API key which saved in Azure Function's Application Settings
+    # The matrix is fetched in chunks of at most MIO_MATRIX_MAX_CELLS cells, MIO_MATRIX_CONCURRENCY chunks at a time
+    # Matrices bigger than MIO_MATRIX_ASYNC_THRESHOLD cells are fetched as DistanceMatrixAsync jobs instead
+    api = BingMapsApi(
+        api_key=os.getenv("BME_KEY"),
+        base_url=os.getenv("MIO_BING_MAPS_URL", "https://dev.virtualearth.net")
+    )
+    return BingMapsProvider(
+        api,
+        max_cells=int(os.getenv("MIO_MATRIX_MAX_CELLS", str(BingMapsProvider.SYNC_MAX_CELLS))),
+        concurrency=int(os.getenv("MIO_MATRIX_CONCURRENCY", "8")),
+        async_threshold=int(os.getenv("MIO_MATRIX_ASYNC_THRESHOLD", "10000"))
+    )
+
+def previous_routes(previous_plan, vehicles, waypoints, first_waypoint_node):
+    """Returns the waypoint nodes of every vehicle in previous_plan, unknown vehicles and waypoints are skipped."""
+    vehicle_index = {vehicle["id"]: i for i, vehicle in enumerate(vehicles)}
+    waypoint_node = {waypoint["id"]: first_waypoint_node + i for i, waypoint in enumerate(waypoints) if "id" in waypoint}
+    routes = [[] for _ in vehicles]
+    for plan in previous_plan:
+        if plan.get("id") not in vehicle_index:
+            continue
+        ids = plan.get("waypoints") or [location.get("id") for location in plan.get("locations", []) if isinstance(location, dict)]
+        routes[vehicle_index[plan["id"]]] = [waypoint_node[i] for i in ids if i in waypoint_node]
+    return routes
+
+async def mio(data: str, on_solution=None) -> (int, str):
+    """Returns (status code, response) for the json request data.
+
+    on_solution(locations, objective) is called with every improving plan (see optimizer()), from a
+    thread while the search runs. Returning True stops the search.
+    """
     try:
         data = json.loads(data)
     except (TypeError, ValueError) as ex:
@@ -29,11 +93,8 @@ async def mio(data: str) -> (int, str):
         return http.client.INTERNAL_SERVER_ERROR, msg
 
     try:
-        # BME_KEY is the environment variable name for the Bing Maps API key which saved in Azure Function's Application Settings
-        api = BingMapsApi(api_key=os.getenv("BME_KEY"))
-
         # Call Bing Maps API to get distance matrix, which is used as input for the optimizer
-        # The distance matrix requires all points (start, end, waypoints) to be in one string
+        # The distance matrix requires all points (start, end, waypoints) as origins and destinations
         vehicles = data.get("vehicles")
         vehicles_start = [vehicle["start"] for vehicle in vehicles]
         vehicles_end = [vehicle["end"] for vehicle in vehicles]
@@ -41,53 +102,149 @@ async def mio(data: str) -> (int, str):
         waypoints_location = [w['location'] for w in waypoints]
         all_points_full_info = vehicles_start + vehicles_end + waypoints
         all_points = vehicles_start + vehicles_end + waypoints_location
-        all_points_str = ";".join([f"{p[1]},{p[0]}" for p in all_points])
-
-        bing_rsp = await api.distance_matrix(origins=all_points_str)
 
-        distance_matrix = [[None] * len(all_points) for i in range(len(all_points))]
-        if "statusCode" in bing_rsp and bing_rsp["statusCode"] == 200:
-            # In this demo we only use the major route and skip the alternative routes
-            # And we use the travelDuration as the distance/penalty between two points
-            bing_distance_matrix = bing_rsp["resourceSets"][0]["resources"][0]["results"]
-            for entry in bing_distance_matrix:
-                distance_matrix[entry["originIndex"]][entry["destinationIndex"]] = entry["travelDuration"]
+        # "matrix_mode": "estimate" builds the matrix locally from great-circle distances without calling
+        # Bing Maps, which is meant for what-if sizing, fleet count estimation and load tests
+        matrix_mode = data.get("matrix_mode", "provider")
+        if matrix_mode == "estimate":
+            provider = EstimateProvider(
+                speed_kph=float(data.get("speed_kph", estimate_speed_kph)),
+                detour_factor=float(data.get("detour_factor", estimate_detour_factor))
+            )
+        elif matrix_mode == "provider":
+            provider = bing_maps_provider()
         else:
-            raise ValueError(f"Error: Bing Maps API call failed:\n{bing_rsp}")
+            return http.client.BAD_REQUEST, f"Error: Unknown matrix_mode {matrix_mode}"
+
+        # In this demo we only use the major route and skip the alternative routes
+        # And we use the travelDuration as the cost between two points and travelDistance for the distance
+        route_matrix = await provider.matrix(all_points, all_points)
+        if not route_matrix.all_valid():
+            raise ValueError(f"Error: {provider.name} could not route between some of the points")
+        # Travel times (seconds) and distances (meters) both come from the same matrix call
+        time_matrix = route_matrix.durations.tolist()
+        distance_matrix = np.rint(route_matrix.distances).astype(np.int64).tolist()
 
         # Call optimizer to get the optimized route
         input_body = {
+            "time_matrix": time_matrix,
             "distance_matrix" : distance_matrix,
             "num_vehicles": len(vehicles),
             "starts": [i for i in range(len(vehicles_start))],
             "ends": [i for i in range(len(vehicles_start), len(vehicles_start) + len(vehicles_end))]
         }
-        optimizer_result = optimizer(input_body)
-
-        output_response = []
-        for vehicle_index, sequence in optimizer_result.items():
-            output_item = {}
-            vehicle = vehicles[vehicle_index]
-            vehicle_id = vehicle["id"]
-            output_item["id"] = vehicle_id
-            output_item["locations"] = []
-            for index in sequence:
-                if index == sequence[0]:    # Start point
-                    location = all_points_full_info[index]
-                    output_item["locations"].append({"id": f"{vehicle_id}_start", "location": location})
-                elif index == sequence[-1]: # End point
-                    location = all_points_full_info[index]
-                    output_item["locations"].append({"id": f"{vehicle_id}_end", "location": location})
-                else:
-                    location = all_points_full_info[index]
-                    output_item["locations"].append(location)
-            output_response.append(output_item)
-
-        return http.client.OK, json.dumps(output_response)
+        # "search" optionally overrides the solver time limit, solution limit, strategies and stall time
+        # "previous_plan" lists, per vehicle id, the waypoint ids of an earlier plan ("waypoints"), or is the
+        # earlier response itself ("locations"). It is the starting point of the solver
+        if data.get("previous_plan"):
+            input_body["initial_routes"] = previous_routes(data["previous_plan"], vehicles, waypoints, len(vehicles_start) + len(vehicles_end))
+        search = dict(data.get("search") or {})
+        if solver_portfolio and "portfolio" not in search:
+            search["portfolio"] = solver_portfolio
+        if search:
+            input_body["search"] = search
+        # Waypoints with a "window" (e.g. a service day or a shift, in any sortable form) are planned one
+        # window after the other. With "carry_over" the vehicles continue from where they stopped
+        windows = sorted({w["window"] for w in waypoints if "window" in w})
+        if len(windows) > 1:
+            first_waypoint_node = len(vehicles_start) + len(vehicles_end)
+            input_body["windows"] = [[first_waypoint_node + i for i, w in enumerate(waypoints) if w.get("window", windows[0]) == window]
+                                     for window in windows]
+            input_body["carry_over"] = bool(data.get("carry_over", False))
+        # The search runs on the solver executor, so other requests keep being served meanwhile
+        if on_solution is None:
+            optimizer_result = await solver_executor.run(optimizer, input_body)
+        else:
+            def report(result, objective):
+                return on_solution(response_locations(result, vehicles, all_points_full_info), objective)
+            optimizer_result = await solver_executor.run(optimizer, input_body, on_solution=report)
+
+        return http.client.OK, json.dumps(response_locations(optimizer_result, vehicles, all_points_full_info))
+    except SolverBusyError as ex:
+        logging.warning(str(ex))
+        return http.client.SERVICE_UNAVAILABLE, str(ex)
     except Exception as ex:
         return http.client.INTERNAL_SERVER_ERROR, f"Error: Unhandled exception:\n{ex}"
 
 
+def response_locations(optimizer_result, vehicles, all_points_full_info):
+    """Turns the nodes of every vehicle returned by the optimizer into the response list of vehicle locations."""
+    output_response = []
+    for vehicle_index, sequence in optimizer_result.items():
+        if vehicle_index == "droppedNodes":
+            logging.warning(f"{len(sequence)} waypoints could not be served")
+            continue
+        output_item = {}
+        vehicle = vehicles[vehicle_index]
+        vehicle_id = vehicle["id"]
+        output_item["id"] = vehicle_id
+        output_item["locations"] = []
+        for index in sequence:
+            if index == sequence[0]:    # Start point
+                location = all_points_full_info[index]
+                output_item["locations"].append({"id": f"{vehicle_id}_start", "location": location})
+            elif index == sequence[-1]: # End point
+                location = all_points_full_info[index]
+                output_item["locations"].append({"id": f"{vehicle_id}_end", "location": location})
+            else:
+                location = all_points_full_info[index]
+                output_item["locations"].append(location)
+        output_response.append(output_item)
+
+    return output_response
+
+
+async def mio_stream(data: str):
+    """Runs mio(data) and yields NDJSON lines: {"objective", "elapsed", "result"} for the first and then
+    at most one improving plan every stream_interval_seconds, and {"status", "result", "final": true} last.
+
+    Closing the generator early (the client went away or has a good enough plan) stops the search at
+    its next improving solution.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    started = time.monotonic()
+    last_sent = [None]
+
+    def on_solution(result, objective):
+        now = time.monotonic()
+        if last_sent[0] is None or now - last_sent[0] >= stream_interval_seconds:
+            last_sent[0] = now
+            line = json.dumps({"objective": objective, "elapsed": round(now - started, 3), "result": result})
+            loop.call_soon_threadsafe(queue.put_nowait, line + "\n")
+        return stopped.is_set()
+
+    task = asyncio.ensure_future(mio(data, on_solution))
+    try:
+        while not task.done() or not queue.empty():
+            line = asyncio.ensure_future(queue.get())
+            await asyncio.wait({line, task}, return_when=asyncio.FIRST_COMPLETED)
+            if line.done():
+                yield line.result()
+            else:
+                line.cancel()
+        status_code, rsp = task.result()
+        result = json.loads(rsp) if status_code == http.client.OK else rsp
+        yield json.dumps({"status": status_code, "result": result, "final": True}) + "\n"
+    finally:
+        stopped.set()
+
+
+
+def solution_key(data):
+    """Solution cache key of the request body, None when caching is off or the body is not a json object."""
+    if solution_cache.max_entries <= 0:
+        return None
+    try:
+        problem = json.loads(data)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(problem, dict):
+        return None
+    return SolutionCache.fingerprint(problem, {"provider": "bing"})
+
+
 
 async def main(req: func.HttpRequest) -> func.HttpResponse:
     init_log()
@@ -100,7 +257,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
             # mio.html will call api/mio after clicking "Get Route" button
             contents = await f.read()
             return func.HttpResponse(contents, mimetype="text/html")
-    elif route_path == "api/mio":
+    elif route_path in ("api/mio", "api/mio/stream"):
         # Get GeoJSON either from query parameter "json" or from request body
         data = req.params.get("json")
         if data:
@@ -112,12 +269,25 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
                     raise ValueError("No json data in request")
             except ValueError:
                 logging.info("No json data in request, using test data")
-                data = test_data
+                data = test_data_path.read_text()
             except Exception as ex:
                 return func.HttpResponse(f"Error: Unhandled exception:\n{ex}", status_code=http.client.INTERNAL_SERVER_ERROR)
+        if route_path == "api/mio/stream":
+            # The Functions host sends an HttpResponse body once it is complete, so the lines arrive together
+            # here. A host which can stream (see examples/stream_server.py) sends every line as it comes
+            lines = [line async for line in mio_stream(data)]
+            return func.HttpResponse("".join(lines), mimetype="application/x-ndjson")
+        # Problems already solved are answered from the solution cache, without matrix call or solve
+        cache_key = solution_key(data)
+        cached = solution_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            logging.info(f"Solution cache hit {cache_key}")
+            return func.HttpResponse(cached, status_code=http.client.OK)
         status_code, rsp = await mio(data)
-        b = f'{{"status": {status_code}, "result": {rsp}}}'
-        json_rsp = json.loads(f'{{"status": {status_code}, "result": {rsp}}}')
+        # Errors are plain messages, only a solved request has a json result
+        json_rsp = {"status": status_code, "result": json.loads(rsp) if status_code == http.client.OK else rsp}
+        if cache_key and status_code == http.client.OK:
+            solution_cache.put(cache_key, json.dumps(dict(json_rsp, cache="hit"), indent=2))
         return func.HttpResponse(json.dumps(json_rsp, indent=2), status_code=status_code)
     else:
         return func.HttpResponse(None, status_code=http.client.NOT_FOUND)
\ No newline at end of file
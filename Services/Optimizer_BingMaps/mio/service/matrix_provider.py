@@ -0,0 +1,168 @@
+import math
+import asyncio
+import logging
+
+import numpy as np
+
+from mio.utils.geo import great_circle_matrix
+
+def tile_shape(num_origins, num_destinations, max_cells):
+    """Returns the (rows, cols) tile size within max_cells which needs the fewest requests."""
+    best = None
+    for rows in range(1, min(num_origins, max_cells) + 1):
+        cols = min(num_destinations, max_cells // rows)
+        count = math.ceil(num_origins / rows) * math.ceil(num_destinations / cols)
+        if best is None or count < best[0]:
+            best = (count, rows, cols)
+    return best[1], best[2]
+
+class MatrixResult:
+    """Route matrix between origins (rows) and destinations (columns).
+
+    durations are int32 seconds, distances float32 meters and valid tells which cells the
+    provider could route. Slicing a result (result[rows, cols]) returns views on the same
+    arrays, which is how tiles are written straight into the final matrix.
+    """
+    def __init__(self, durations, distances, valid) -> None:
+        self.durations = durations
+        self.distances = distances
+        self.valid = valid
+
+    @classmethod
+    def empty(cls, num_origins, num_destinations):
+        return cls(
+            np.zeros((num_origins, num_destinations), dtype=np.int32),
+            np.zeros((num_origins, num_destinations), dtype=np.float32),
+            np.zeros((num_origins, num_destinations), dtype=bool)
+        )
+
+    @property
+    def shape(self):
+        return self.durations.shape
+
+    def __getitem__(self, key):
+        return MatrixResult(self.durations[key], self.distances[key], self.valid[key])
+
+    def all_valid(self):
+        return bool(self.valid.all())
+
+class MatrixProvider:
+    """Common interface of the route matrix providers.
+
+    A provider implements fetch_tile() for a block within max_cells cells, matrix() splits any
+    origins x destinations request into such tiles and fetches them concurrently. Points are
+    [lon, lat] lists, start_time an optional ISO 8601 departure time.
+    """
+    name = "provider"
+    travel_mode = "car"
+
+    def __init__(self, max_cells=100, concurrency=8) -> None:
+        self.max_cells = max_cells
+        self.concurrency = concurrency
+
+    def tile_cells(self, num_cells):
+        """Maximum tile size for a matrix of num_cells cells."""
+        return self.max_cells
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        """Fetches one tile into out (a MatrixResult view of len(origins) x len(destinations))."""
+        raise NotImplementedError
+
+    async def matrix(self, origins, destinations, start_time=None):
+        result = MatrixResult.empty(len(origins), len(destinations))
+        if not origins or not destinations:
+            return result
+        num_cells = len(origins) * len(destinations)
+        rows, cols = tile_shape(len(origins), len(destinations), self.tile_cells(num_cells))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(row_start, col_start):
+            tile_origins = origins[row_start:row_start + rows]
+            tile_destinations = destinations[col_start:col_start + cols]
+            out = result[row_start:row_start + len(tile_origins), col_start:col_start + len(tile_destinations)]
+            async with semaphore:
+                await self.fetch_tile(tile_origins, tile_destinations, out, start_time, num_cells)
+
+        tiles = [(r, c) for r in range(0, len(origins), rows) for c in range(0, len(destinations), cols)]
+        logging.info(f"{self.name} matrix {len(origins)}x{len(destinations)} split into {len(tiles)} tiles of {rows}x{cols}")
+        await asyncio.gather(*[fetch(r, c) for r, c in tiles])
+        return result
+
+    async def rows(self, origins, destinations_per_origin, start_time=None):
+        """Returns one 1 x len(destinations) MatrixResult per origin, for sparse matrices.
+
+        Every row is fetched on its own (split at max_cells), at most self.concurrency at a time.
+        """
+        results = [MatrixResult.empty(1, len(destinations)) for destinations in destinations_per_origin]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(row, col_start):
+            tile_destinations = destinations_per_origin[row][col_start:col_start + self.max_cells]
+            out = results[row][:, col_start:col_start + len(tile_destinations)]
+            async with semaphore:
+                await self.fetch_tile([origins[row]], tile_destinations, out, start_time)
+
+        tiles = [(row, c) for row, destinations in enumerate(destinations_per_origin)
+                 for c in range(0, len(destinations), self.max_cells)]
+        logging.info(f"{self.name} matrix rows for {len(origins)} origins split into {len(tiles)} tiles")
+        await asyncio.gather(*[fetch(row, c) for row, c in tiles])
+        return results
+
+class EstimateProvider(MatrixProvider):
+    """Great-circle distance stretched by detour_factor and driven at speed_kph, computed locally."""
+    name = "estimate"
+    travel_mode = "estimate"
+
+    def __init__(self, speed_kph=40, detour_factor=1.3) -> None:
+        super().__init__(max_cells=10**9)
+        self.speed_kph = speed_kph
+        self.detour_factor = detour_factor
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        distances = great_circle_matrix(origins, destinations)
+        np.multiply(distances, self.detour_factor, out=distances)
+        out.distances[...] = distances
+        np.multiply(distances, 3.6 / self.speed_kph, out=distances)
+        out.durations[...] = np.rint(distances)
+        out.valid[...] = True
+
+    async def matrix(self, origins, destinations, start_time=None):
+        result = MatrixResult.empty(len(origins), len(destinations))
+        if origins and destinations:
+            await self.fetch_tile(origins, destinations, result, start_time)
+        return result
+
+class DeterministicProvider(MatrixProvider):
+    """In-process provider for tests and benchmarks.
+
+    The detour over the great-circle distance varies per pair but only depends on the
+    coordinates, so the same request always returns the same matrix. latency (seconds, or a
+    function returning the seconds of each call) is added to every tile, the first fail_calls
+    tiles raise like a throttled (429) provider and calls counts the tiles fetched.
+    """
+    name = "deterministic"
+
+    def __init__(self, max_cells=100, concurrency=8, latency=0.0, speed_kph=40, fail_calls=0, name=None) -> None:
+        super().__init__(max_cells=max_cells, concurrency=concurrency)
+        self.latency = latency
+        self.speed_kph = speed_kph
+        self.fail_calls = fail_calls
+        self.name = name or self.name
+        self.calls = 0
+
+    async def fetch_tile(self, origins, destinations, out, start_time=None, num_cells=None):
+        self.calls += 1
+        call = self.calls
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        if call <= self.fail_calls:
+            raise ValueError(f"Error: {self.name} returned 429 Too Many Requests")
+        o = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+        d = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+        seed = o[:, 0:1] * 12.9898 + o[:, 1:2] * 78.233 + d[:, 0] * 37.719 + d[:, 1] * 4.581
+        detour = 1.2 + 0.4 * np.modf(np.abs(np.sin(seed) * 43758.5453))[0]
+        distances = great_circle_matrix(origins, destinations) * detour
+        out.distances[...] = distances
+        out.durations[...] = np.rint(distances * (3.6 / self.speed_kph))
+        out.valid[...] = True
@@ -0,0 +1,61 @@
+import os
+import atexit
+import asyncio
+import logging
+
+import aiohttp
+
+# One connection pool per process, reused across Function invocations so that the TCP/TLS
+# handshake with the maps service is paid once per connection instead of once per request
+_session = None
+_session_loop = None
+
+def get_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session, creating it on first use (or when the event loop changed)."""
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        if _session is not None and not _session.closed:
+            logging.info("Event loop changed, closing the previous HTTP session")
+            close_stale_session(_session, _session_loop)
+        connector = aiohttp.TCPConnector(
+            limit=int(os.getenv("MIO_HTTP_POOL_SIZE", "100")),
+            limit_per_host=int(os.getenv("MIO_HTTP_POOL_SIZE_PER_HOST", "32")),
+            ttl_dns_cache=int(os.getenv("MIO_HTTP_DNS_CACHE_SECONDS", "300")),
+            keepalive_timeout=float(os.getenv("MIO_HTTP_KEEPALIVE_SECONDS", "60")),
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv("MIO_HTTP_TIMEOUT_SECONDS", "120")),
+            sock_connect=float(os.getenv("MIO_HTTP_CONNECT_TIMEOUT_SECONDS", "10")),
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _session_loop = loop
+        logging.info("HTTP session created")
+    return _session
+
+def close_stale_session(session, loop) -> None:
+    """Closes a session created on another event loop, so that its connections are not leaked."""
+    if loop.is_running():
+        # The loop still serves in another thread, the session is closed there
+        asyncio.run_coroutine_threadsafe(session.close(), loop)
+        return
+    try:
+        # Closing the connector empties its pool and marks the session closed. The sockets of a loop which
+        # is already closed cannot be closed through it any more, they are released when collected
+        session.connector.close()
+    except RuntimeError as ex:
+        logging.warning(f"Closing the previous HTTP session failed: {ex}")
+
+@atexit.register
+def close_session_at_exit() -> None:
+    # The Functions host has no shutdown hook for the Python worker, the pool is closed when the process exits.
+    # Hosts which run their own event loop (see examples/stream_server.py) await close_session() on shutdown
+    if _session is not None and not _session.closed:
+        close_stale_session(_session, _session_loop)
+
+async def close_session() -> None:
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
@@ -0,0 +1,43 @@
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+class SolutionCache:
+    """Least recently used cache of optimizer responses with a time to live.
+
+    Entries are keyed by fingerprint(), so requests which only differ in the order of their
+    waypoints or of their json keys share an entry. At most max_entries are kept, each one for
+    ttl_seconds at most (travel times change with the traffic).
+    """
+    def __init__(self, max_entries=256, ttl_seconds=300) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()   # key -> (value, expiry timestamp)
+
+    @staticmethod
+    def fingerprint(problem, context=None):
+        """Canonical hash of a request (parsed json) and of the settings which change its matrix."""
+        problem = dict(problem)
+        if isinstance(problem.get("waypoints"), list):
+            problem["waypoints"] = sorted(problem["waypoints"], key=lambda w: json.dumps(w, sort_keys=True))
+        canonical = json.dumps({"problem": problem, "context": context}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
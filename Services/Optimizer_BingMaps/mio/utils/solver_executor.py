@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+class SolverBusyError(RuntimeError):
+    pass
+
+def call_reporting(function, args, queue, stop):
+    """Runs function(*args, on_solution) in a solver process, on_solution puts its arguments on queue
+    and returns whether stop is set. A None on queue marks the end of the call."""
+    def on_solution(*solution):
+        queue.put(solution)
+        return stop.is_set()
+    try:
+        return function(*args, on_solution)
+    finally:
+        queue.put(None)
+
+class SolverExecutor:
+    """Runs the CPU bound solves off the event loop, on at most `workers` processes or threads.
+
+    At most `max_queue` more solves wait for a worker, run() raises SolverBusyError beyond that
+    so the request is turned away at once instead of queuing behind the time limits of the others.
+    OR-Tools keeps the GIL while it searches, so only "process" leaves the event loop free during a
+    solve, "thread" avoids copying the data to another process for hosts which serve one request at a time.
+    """
+    def __init__(self, kind="process", workers=1, max_queue=4, initializer=None, initargs=()) -> None:
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Error: Unknown solver executor {kind}, expected thread or process")
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        # initializer(*initargs) runs once in every solver process
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pending = 0
+        self.executor = None
+        self.manager = None
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.kind == "process":
+                # spawn, a forked copy of the Function host (event loop, sockets, threads) is not safe to use
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=self.initializer, initargs=self.initargs)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="solver")
+        return self.executor
+
+    def get_manager(self):
+        # The queues of the reporting calls live in a manager process, so they can be passed to the solver processes
+        if self.manager is None:
+            self.manager = multiprocessing.get_context("spawn").Manager()
+        return self.manager
+
+    async def run(self, function, *args, on_solution=None):
+        """Returns function(*args) computed on a worker.
+
+        With on_solution, function(*args, callback) is called instead and every callback(*values)
+        is forwarded to on_solution(*values) on a thread of this process, whose return value goes
+        back to the callback.
+        """
+        if self.pending >= self.workers + self.max_queue:
+            raise SolverBusyError(f"Error: All {self.workers} solvers are busy and {self.max_queue} requests are waiting, retry later")
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        try:
+            if on_solution is None:
+                return await loop.run_in_executor(self.get_executor(), functools.partial(function, *args))
+            if self.kind == "thread":
+                return await loop.run_in_executor(self.get_executor(), functools.partial(function, *args, on_solution))
+
+            manager = self.get_manager()
+            queue, stop = manager.Queue(), manager.Event()
+
+            def forward():
+                for solution in iter(queue.get, None):
+                    if on_solution(*solution):
+                        stop.set()
+
+            forwarding = loop.run_in_executor(None, forward)
+            try:
+                return await loop.run_in_executor(self.get_executor(), functools.partial(call_reporting, function, args, queue, stop))
+            finally:
+                # Ends the forwarding when the solver process died before its own end marker
+                queue.put(None)
+                await forwarding
+        except BrokenProcessPool:
+            # A crashed solver process breaks the pool, the next request starts a new one
+            self.executor = None
+            raise
+        finally:
+            self.pending -= 1